@@ -0,0 +1,129 @@
+import itertools
+import json
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import snapshot_store
+
+# Background "Create Application" exports.
+#
+# A JobRunner owns a small thread pool; each submitted export becomes a Job
+# whose status and progress the UI polls, so the script thread never waits on
+# the write. Several exports can be queued at once and run in submit order.
+#
+# Applications are kept in snapshot_store, so saving the same conversation
+# under several names (or saving it again after a few edits) stores each
+# message only once. export_application() rebuilds the classic
+# <name>_application.json document on demand.
+
+JOB_WORKERS = 2  # Exports that may run at the same time
+GC_EVERY_SAVES = 20  # Saves between sweeps of chunks no application uses any more
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_saves = itertools.count(1)
+
+
+def application_name(app_name):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", app_name.strip()) + "_application"
+
+
+@metrics.timed("save_application")
+def write_application(history, app_name, progress=None, root=snapshot_store.SNAPSHOT_DIR):
+    total = len(history)
+    name = application_name(app_name)
+    snapshot_store.save_snapshot(
+        root, name, history, meta={"appName": app_name},
+        progress=(lambda count: progress(count / total)) if progress is not None else None,
+    )
+    # Chunks only a replaced version used are freed every so often; the sweep
+    # reads every manifest and blocks saves while it runs
+    if next(_saves) % GC_EVERY_SAVES == 0:
+        snapshot_store.collect_garbage(root)
+    return name
+
+
+def export_application(name, root=snapshot_store.SNAPSHOT_DIR):
+    # Same document json.dump(app_data, f, indent=2) produces, written a
+    # message at a time into a temporary file that replaces the target at the
+    # end, so a half-written file is never visible.
+    manifest = snapshot_store.load_manifest(root, name)
+    if manifest is None:
+        raise KeyError(f"No application named {name!r}")
+    filename = f"{name}.json"
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write('{\n  "appName": %s,\n  "conversation": [' % json.dumps(manifest["meta"]["appName"]))
+            empty = True
+            for message in snapshot_store.iter_snapshot(root, name):
+                f.write("\n" if empty else ",\n")
+                f.write("\n".join("    " + line for line in json.dumps(message, indent=2).splitlines()))
+                empty = False
+            f.write("]\n}" if empty else "\n  ]\n}")
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return filename
+
+
+class Job:
+    def __init__(self, job_id, name):
+        self.id = job_id
+        self.name = name
+        self.status = QUEUED
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+
+class JobRunner:
+    def __init__(self, max_workers=JOB_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="application-job")
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, name, fn, *args):
+        # fn(*args, progress=callback) runs on a worker thread; its return
+        # value becomes job.result.
+        with self._lock:
+            job_id = next(self._ids)
+            job = self._jobs[job_id] = Job(job_id, name)
+        self._executor.submit(self._run, job, fn, args)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def discard(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _run(self, job, fn, args):
+        job.status = RUNNING
+
+        def progress(fraction):
+            job.progress = min(1.0, fraction)
+
+        try:
+            job.result = fn(*args, progress=progress)
+        except Exception as e:
+            job.error = str(e)
+            job.status = FAILED
+        else:
+            job.progress = 1.0
+            job.status = DONE
@@ -0,0 +1,320 @@
+import argparse
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import conversation_storage
+import history_export
+import history_store
+
+# Benchmarks for the conversation-history apps at realistic sizes.
+#
+# A synthetic conversation (alternating user prompts and coder replies, a mix
+# of prose, code and execution results) is generated for each size and every
+# variant's storage path is timed against it:
+#
+#   streamlit        streamlit-conversation-app.py, (1) and (4): whole history
+#                    in session state, list slicing for pages
+#   streamlit-paged  (2) and (3): indexed page reads, ops appended without a load
+#   stateless        streamlit-conversation-history-stateless.py: reload + replay
+#   fastui           fastui-conversation-history.py's ConversationState and
+#                    generate_csv (skipped when fastapi/fastui are missing)
+#   chainlit         chainlit_app.py's session log: exchange appends and
+#                    "earlier" page reads
+#
+# Results are written as JSON. Given --baseline, each result is compared with
+# the stored one and the run fails if any got slower than --threshold allows:
+#
+#   python benchmark.py --sizes 1000 100000 --output results.json
+#   python benchmark.py --baseline benchmark_baseline.json --update-baseline
+#   python benchmark.py --baseline benchmark_baseline.json --threshold 0.25
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.25  # Allowed slowdown over the baseline
+NOISE_FLOOR = 0.001  # Seconds; differences below this are never regressions
+PAGE_SIZE = 5  # MESSAGES_PER_PAGE in the paginated apps
+EARLIER_EXCHANGES = 10  # Same as chainlit_app.py
+APPS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+WORDS = (
+    "function value list index result error test loop recursion cache memory "
+    "input output string number return call class method module import file "
+    "performance iterative factorial example case base stack overflow python"
+).split()
+CODE_TEMPLATES = [
+    "def {name}(n):\n    if n <= 1:\n        return 1\n    return n * {name}(n - 1)",
+    "def {name}(items):\n    result = []\n    for item in items:\n        if item % {k} == 0:\n            result.append(item)\n    return result",
+    "class {Name}:\n    def __init__(self, size={k}):\n        self.size = size\n        self.items = []\n\n    def add(self, item):\n        self.items.append(item)",
+    "import json\n\nwith open('{name}.json') as f:\n    data = json.load(f)\nprint(len(data['{name}']))",
+]
+
+
+def _sentence(rng, low, high):
+    words = rng.choices(WORDS, k=rng.randint(low, high))
+    return " ".join(words).capitalize() + "."
+
+
+def generate_conversation(count, seed=0):
+    rng = random.Random(seed)
+    history = []
+    for message_id in range(1, count + 1):
+        if message_id % 2:
+            sender = "User"
+            content = _sentence(rng, 6, 20).rstrip(".") + "?"
+        else:
+            sender = "Coder"
+            kind = rng.random()
+            if kind < 0.4:
+                name = rng.choice(WORDS) + "_" + rng.choice(WORDS)
+                content = rng.choice(CODE_TEMPLATES).format(name=name, Name=name.title().replace("_", ""), k=rng.randint(2, 9))
+            elif kind < 0.55:
+                content = "Execution result: " + rng.choice(["Success", f"Error on line {rng.randint(1, 80)}", str(rng.randint(1, 10**6))])
+            else:
+                content = " ".join(_sentence(rng, 8, 25) for _ in range(rng.randint(1, 5)))
+        history.append({"id": message_id, "sender": sender, "content": content})
+    return history
+
+
+def _drain(f):
+    # Exports hand back an open temp file; reading it makes the cost comparable
+    # to the download it feeds.
+    with f:
+        while f.read(1 << 20):
+            pass
+
+
+def streamlit_session(storage, history):
+    conversation_id = "streamlit"
+    storage.save_history(conversation_id, history)
+    ids = itertools.count(len(history) + 1)
+    added = []
+    rng = random.Random(1)
+
+    def add():
+        message = {"id": next(ids), "sender": "User", "content": "New message"}
+        storage.commit_ops(conversation_id, [conversation_storage.add_op(message)], history)
+        added.append(message["id"])
+
+    yield "load_history", lambda: storage.load_history(conversation_id)
+    yield "save_history", lambda: storage.save_history(conversation_id, history)
+    yield "page_slice", lambda: history[len(history) // 2:len(history) // 2 + PAGE_SIZE]
+    yield "add", add
+    yield "edit", lambda: storage.commit_ops(conversation_id, [conversation_storage.edit_op(
+        rng.randint(1, len(history)), content="Edited")], history)
+    yield "delete", lambda: storage.commit_ops(conversation_id, [conversation_storage.delete_op(added.pop())], history)
+    yield "export_csv", lambda: _drain(history_export.export_history(history_export.batched(history), "CSV")[0])
+
+
+def streamlit_paged(storage, history):
+    conversation_id = "paged"
+    storage.save_history(conversation_id, history)
+    ids = itertools.count(len(history) + 1)
+    added = []
+    rng = random.Random(2)
+
+    def page():
+        pages = storage.open_pages(conversation_id)
+        return pages.read(pages.total // 2, PAGE_SIZE)
+
+    def add():
+        message = {"id": next(ids), "sender": "User", "content": "New message"}
+        storage.append_ops(conversation_id, [conversation_storage.add_op(message)])
+        added.append(message["id"])
+
+    yield "page_read", page
+    yield "add", add
+    yield "edit", lambda: storage.append_ops(conversation_id, [conversation_storage.edit_op(
+        rng.randint(1, len(history)), content="Edited")])
+    yield "delete", lambda: storage.append_ops(conversation_id, [conversation_storage.delete_op(added.pop())])
+    yield "export_csv", lambda: _drain(history_export.export_history(
+        storage.open_pages(conversation_id).batches(history_export.EXPORT_BATCH_SIZE), "CSV")[0])
+
+
+def stateless(storage, history):
+    conversation_id = "stateless"
+    storage.save_history(conversation_id, history)
+    rng = random.Random(3)
+
+    def edit():
+        current = tuple(storage.load_history(conversation_id))  # A cache miss after each change
+        op = conversation_storage.edit_op(rng.randint(1, len(history)), content="Edited")
+        conversation_storage.replay(current, [op])
+        storage.append_ops(conversation_id, [op])
+
+    yield "load_history", lambda: storage.load_history(conversation_id)
+    yield "edit", edit
+
+
+def _load_fastui():
+    spec = importlib.util.spec_from_file_location(
+        "fastui_conversation_history", os.path.join(APPS_DIR, "fastui-conversation-history.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def fastui(storage, history):
+    try:
+        module = _load_fastui()
+    except ImportError as e:
+        print(f"Skipping fastui: {e}", file=sys.stderr)
+        return
+    conversation_id = "fastui"
+    storage.save_history(conversation_id, history)
+    state = module.ConversationState(storage, conversation_id)
+    rng = random.Random(4)
+    added = []
+
+    def generate_csv():
+        for _ in module.generate_csv(state):
+            pass
+
+    yield "load_history", state.reload
+    yield "page_slice", lambda: list(state.messages)
+    yield "add", lambda: added.append(state.add_message("User", "New message").id)
+    yield "edit", lambda: state.edit_message(rng.randint(1, len(history)), content="Edited")
+    yield "delete", lambda: state.delete_message(added.pop())
+    yield "generate_csv", generate_csv
+
+
+def chainlit(storage, history):
+    conversation_id = "session_benchmark"
+    storage.save_history(conversation_id, history)
+    ids = itertools.count(len(history) + 1)
+
+    def log_exchange():
+        first_id = next(ids)
+        next(ids)
+        storage.commit_ops(conversation_id, [
+            conversation_storage.add_op({"id": first_id, "sender": "User", "content": "Question"}),
+            conversation_storage.add_op({"id": first_id + 1, "sender": "Assistant", "content": "Answer"}),
+        ], history=[])
+
+    def earlier():
+        pages = storage.open_pages(conversation_id)
+        return pages.read(max(0, pages.total - 2 * EARLIER_EXCHANGES), 2 * EARLIER_EXCHANGES)
+
+    yield "log_exchange", log_exchange
+    yield "earlier", earlier
+
+
+VARIANTS = {
+    "streamlit": streamlit_session,
+    "streamlit-paged": streamlit_paged,
+    "stateless": stateless,
+    "fastui": fastui,
+    "chainlit": chainlit,
+}
+STORAGES = {
+    "file": lambda directory: conversation_storage.FileStorage(os.path.join(directory, "conversation_history.json")),
+    "sqlite": lambda directory: conversation_storage.SQLiteStorage(os.path.join(directory, "conversations.db")),
+}
+
+
+def run(sizes, variants, storages, repeat):
+    results = []
+    cwd = os.getcwd()
+    for size in sizes:
+        history = generate_conversation(size)
+        for storage_name in storages:
+            for variant in variants:
+                with tempfile.TemporaryDirectory() as directory:
+                    os.chdir(directory)  # Apps create their default files in the working directory
+                    storage = STORAGES[storage_name](directory)
+                    for operation, fn in VARIANTS[variant](storage, history):
+                        timings = []
+                        for _ in range(repeat):
+                            start = time.perf_counter()
+                            fn()
+                            timings.append(time.perf_counter() - start)
+                        result = {
+                            "variant": variant,
+                            "storage": storage_name,
+                            "operation": operation,
+                            "size": size,
+                            "seconds": min(timings),
+                            "median_seconds": statistics.median(timings),
+                        }
+                        results.append(result)
+                        print(f"{variant:16} {storage_name:7} {operation:13} {size:>9} {result['seconds']:.6f}s", file=sys.stderr)
+                    os.chdir(cwd)
+    return results
+
+
+def _key(result):
+    return (result["variant"], result["storage"], result["operation"], result["size"])
+
+
+def compare(results, baseline, threshold):
+    # Regressions: results slower than their baseline by more than `threshold`
+    expected = {_key(result): result["seconds"] for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = expected.get(_key(result))
+        if before is None:
+            continue
+        if result["seconds"] > before * (1 + threshold) and result["seconds"] - before > NOISE_FLOOR:
+            regressions.append({**result, "baseline_seconds": before, "ratio": result["seconds"] / before})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the conversation-history apps.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--variants", nargs="+", choices=list(VARIANTS), default=list(VARIANTS))
+    parser.add_argument("--storage", nargs="+", choices=list(STORAGES), default=["file"])
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--output", help="Write results here instead of stdout")
+    parser.add_argument("--baseline", help="Baseline results to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--update-baseline", action="store_true", help="Store these results as the baseline")
+    args = parser.parse_args(argv)
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "compression": history_store.SNAPSHOT_CODEC,
+            "repeat": args.repeat,
+        },
+        "results": run(args.sizes, args.variants, args.storage, args.repeat),
+    }
+
+    exit_code = 0
+    if args.baseline and not args.update_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            report["regressions"] = compare(report["results"], json.load(f), args.threshold)
+        for regression in report["regressions"]:
+            print(
+                f"REGRESSION {regression['variant']} {regression['storage']} {regression['operation']} "
+                f"{regression['size']}: {regression['seconds']:.6f}s vs {regression['baseline_seconds']:.6f}s",
+                file=sys.stderr,
+            )
+        exit_code = 1 if report["regressions"] else 0
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.update_baseline:
+        if not args.baseline:
+            parser.error("--update-baseline needs --baseline")
+        with open(args.baseline, "w") as f:
+            f.write(output + "\n")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,23 +1,135 @@
 import chainlit as cl
 from chainlit.action import Action
-import json
+from chainlit.server import app
+from fastapi.responses import PlainTextResponse
+from collections import deque
 from datetime import datetime
+import itertools
+import json
+import os
+import sys
+import conversation_storage
+import metrics
+import snapshot_store
+
+# Session logs go to the shared conversation storage; saved conversations are
+# deduplicated snapshots of them
+storage = conversation_storage.open_storage("file:conversation_history.json")
+SNAPSHOT_BATCH_SIZE = 1000  # Log messages read per batch when saving
+
+# Per-session in-memory window; older exchanges are only kept in the session log
+WINDOW_EXCHANGES = int(os.environ.get("CHAINLIT_WINDOW_EXCHANGES", 200))
+WINDOW_BYTES = int(os.environ.get("CHAINLIT_WINDOW_BYTES", 1024 * 1024))
+EARLIER_EXCHANGES = 10  # Exchanges shown by "Show Earlier Exchanges"
+
+# Bytes held by each session's window, for operators
+session_memory = {}
+
+class ConversationWindow:
+    # Ring buffer of a session's most recent exchanges, bounded by count and
+    # size. Everything is also in the session log, so exchanges that fall out
+    # of the window are read back from disk only when asked for.
+    def __init__(self, session_id):
+        self.session_id = session_id
+        # Every exchange is appended to this conversation
+        self.log_id = f"{conversation_storage.SESSION_LOG_PREFIX}{session_id}"
+        self.exchanges = deque()
+        self.bytes = 0
+        self.first_index = 0  # Position of exchanges[0] in the whole conversation
+        self.earliest_shown = None  # Position "Show Earlier Exchanges" has reached
+
+    def __len__(self):
+        return self.first_index + len(self.exchanges)
+
+    def append(self, exchange):
+        size = sys.getsizeof(exchange["user"]) + sys.getsizeof(exchange["assistant"])
+        self.exchanges.append((exchange, size))
+        self.bytes += size
+        while len(self.exchanges) > WINDOW_EXCHANGES or (self.bytes > WINDOW_BYTES and len(self.exchanges) > 1):
+            _, evicted = self.exchanges.popleft()
+            self.bytes -= evicted
+            self.first_index += 1
+        session_memory[self.session_id] = self.bytes
+
+    def earlier(self, count):
+        # The `count` exchanges before those shown by the last call (at first,
+        # before the window), from the session log
+        end = self.first_index if self.earliest_shown is None else self.earliest_shown
+        start = max(0, end - count)
+        pages = storage.open_pages(self.log_id)
+        if pages is None or start == end:
+            return []
+        self.earliest_shown = start
+        messages = pages.read(2 * start, 2 * (end - start))
+        return [
+            {"user": user["content"], "assistant": assistant["content"]}
+            for user, assistant in zip(messages[::2], messages[1::2])
+        ]
+
+    def close(self):
+        session_memory.pop(self.session_id, None)
+
+@app.get("/session-memory")
+def session_memory_usage():
+    # Aggregates only, so session ids aren't exposed
+    sizes = list(session_memory.values())
+    return {
+        "sessions": len(sizes),
+        "total_bytes": sum(sizes),
+        "max_bytes": max(sizes, default=0),
+        "window_exchanges": WINDOW_EXCHANGES,
+        "window_bytes": WINDOW_BYTES,
+    }
+
+def log_exchange(log_id, exchange, first_id):
+    # Flatten a {"user", "assistant"} exchange into the apps' message records
+    storage.commit_ops(log_id, [
+        conversation_storage.add_op({"id": first_id, "sender": "User", "content": exchange["user"]}),
+        conversation_storage.add_op({"id": first_id + 1, "sender": "Assistant", "content": exchange["assistant"]}),
+    ], history=[])
+
+def finalise_conversation(log_id, conversation_id):
+    # Repeated saves of a growing session share every chunk but the last few
+    pages = storage.open_pages(log_id)
+    messages = itertools.chain.from_iterable(pages.batches(SNAPSHOT_BATCH_SIZE)) if pages is not None else []
+    snapshot_store.save_snapshot(snapshot_store.SNAPSHOT_DIR, conversation_id, messages)
+
+def export_conversation(conversation_id):
+    # Rebuilds the classic conversation_<ts>.json document (a list of
+    # {"user", "assistant"} exchanges) from the snapshot, a message at a time
+    filename = f"{conversation_id}.json"
+    messages = snapshot_store.iter_snapshot(snapshot_store.SNAPSHOT_DIR, conversation_id)
+    with open(filename + ".tmp", "w") as f:
+        f.write("[")
+        for number, (user, assistant) in enumerate(zip(messages, messages)):
+            f.write(",\n" if number else "\n")
+            exchange = {"user": user["content"], "assistant": assistant["content"]}
+            f.write("\n".join("  " + line for line in json.dumps(exchange, indent=2).splitlines()))
+        f.write("\n]")
+    os.replace(filename + ".tmp", filename)
+    return filename
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 # Function to handle the save action
+@metrics.timed("save_conversation")
 async def save_conversation(action):
-    # Get the current conversation
-    conversation = cl.user_session.get("conversation")
-    
-    # Create a filename with current timestamp
+    # Name the saved conversation with the current timestamp
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"conversation_{timestamp}.json"
+    conversation_id = f"conversation_{timestamp}"
     
-    # Save the conversation to a file
-    with open(filename, "w") as f:
-        json.dump(conversation, f, indent=2)
+    # The session log already holds every exchange, so saving only snapshots
+    # it; storage I/O runs in a worker thread to keep the event loop free
+    window = cl.user_session.get("conversation")
+    await cl.make_async(finalise_conversation)(window.log_id, conversation_id)
     
-    # Send a message to the user
-    await cl.Message(f"Conversation saved as {filename}").send()
+    # Send a message to the user; the JSON document is only written if asked for
+    await cl.Message(
+        f"Conversation saved as {conversation_id}",
+        actions=[cl.Action(name="export_conversation", value=conversation_id, label=f"Download {conversation_id}.json")],
+    ).send()
 
 # Define the custom action
 save_action = Action(
@@ -26,22 +138,55 @@ save_action = Action(
     description="Save the current conversation to a file",
 )
 
+earlier_action = Action(
+    name="show_earlier",
+    label="Show Earlier Exchanges",
+    description="Show exchanges that are no longer held in memory",
+)
+
 @cl.on_chat_start
 async def start():
-    # Add the custom action to the interface
+    cl.user_session.set("conversation", ConversationWindow(cl.user_session.get("id")))
+
+    # Add the custom actions to the interface
     await cl.Action(save_action).send()
+    await cl.Action(earlier_action).send()
+
+@cl.on_chat_end
+async def end():
+    cl.user_session.get("conversation").close()
 
 @cl.action_callback("save_conversation")
 async def on_action(action):
     await save_conversation(action)
 
+@cl.action_callback("export_conversation")
+async def on_export(action):
+    filename = await cl.make_async(export_conversation)(action.value)
+    await cl.Message(f"Exported {filename}", elements=[cl.File(name=filename, path=filename)]).send()
+
+@cl.action_callback("show_earlier")
+async def on_show_earlier(action):
+    window = cl.user_session.get("conversation")
+    earlier = await cl.make_async(window.earlier)(EARLIER_EXCHANGES)
+    if not earlier:
+        await cl.Message("Every exchange of this conversation is already shown.").send()
+        return
+    lines = [f"**User:** {e['user']}\n\n**Assistant:** {e['assistant']}" for e in earlier]
+    await cl.Message("\n\n---\n\n".join(lines)).send()
+
 @cl.on_message
+@metrics.timed("on_message")
 async def main(message: str):
     # Your main chat logic here
     response = f"You said: {message}"
     await cl.Message(response).send()
 
-    # Store the conversation in the user session
-    if "conversation" not in cl.user_session:
-        cl.user_session.set("conversation", [])
-    cl.user_session.get("conversation").append({"user": message, "assistant": response})
+    # Store the conversation in the user session's bounded window
+    window = cl.user_session.get("conversation")
+    exchange = {"user": message, "assistant": response}
+    first_id = 2 * len(window) + 1
+    window.append(exchange)
+
+    # Append the exchange to the session log off the event loop
+    await cl.make_async(log_exchange)(window.log_id, exchange, first_id)
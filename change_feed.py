@@ -0,0 +1,85 @@
+import collections
+import itertools
+import json
+import threading
+
+import conversation_storage
+
+# Sequenced change events for live views.
+#
+# A feed hands out the changes committed to a conversation as (seq, ops) in
+# commit order, where ops is a list of history_store ops, or None when the
+# conversation was replaced wholesale. Clients keep the last seq they have
+# applied and ask for what came after it. since() answers None instead of a
+# list when it can no longer tell (the log was pruned past that seq, or the
+# seq is from before a restart); the client then reloads and carries on from
+# the position returned with it.
+#
+# Storages with a change log (SQLite) are read straight from the log, so the
+# feed sees every process's writes. For the others the feed buffers the
+# changes committed through this process, as reported by subscribe().
+
+FEED_BUFFER_SIZE = 10_000  # Changes kept by an in-process feed
+
+_feeds = {}
+_feeds_lock = threading.Lock()
+
+
+class LogFeed:
+    def __init__(self, storage):
+        self.storage = storage
+
+    def position(self):
+        return self.storage.log_position()
+
+    def since(self, conversation_id, seq):
+        position, changes = self.storage.changes_since(conversation_id, seq)
+        if seq > position:
+            return position, None  # The database was recreated
+        return position, changes
+
+
+class MemoryFeed:
+    def __init__(self, storage):
+        self.storage = storage
+        self._changes = collections.deque(maxlen=FEED_BUFFER_SIZE)  # (seq, conversation_id, ops)
+        self._seqs = itertools.count(1)
+        self._position = 0
+        self._lock = threading.Lock()
+        conversation_storage.subscribe(self._record)
+
+    def _record(self, storage, conversation_id, ops):
+        if storage is not self.storage:
+            return
+        with self._lock:
+            self._position = next(self._seqs)
+            self._changes.append((self._position, conversation_id, ops))
+
+    def position(self):
+        return self._position
+
+    def since(self, conversation_id, seq):
+        with self._lock:
+            oldest = self._changes[0][0] if self._changes else self._position + 1
+            if seq > self._position or seq < oldest - 1:
+                return self._position, None
+            return self._position, [
+                (change_seq, ops) for change_seq, change_id, ops in self._changes
+                if change_seq > seq and change_id == conversation_id
+            ]
+
+
+def open_feed(storage):
+    with _feeds_lock:
+        if storage not in _feeds:
+            _feeds[storage] = LogFeed(storage) if storage.log_position() is not None else MemoryFeed(storage)
+        return _feeds[storage]
+
+
+def sse_event(event, data, event_id=None):
+    # One server-sent event; `data` is sent as JSON on a single line
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
@@ -0,0 +1,606 @@
+import contextlib
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import history_store
+import metrics
+from history_store import ConflictError, add_op, delete_op, edit_op, message_version, replay
+
+# Pluggable conversation storage shared by the Streamlit, FastUI and Chainlit
+# apps.
+#
+# Every backend stores conversations by id and speaks the same op format as
+# history_store (add/edit/delete with optional base versions):
+#
+#   load_history(cid) / save_history(cid, history)
+#   commit_ops(cid, ops, history=None) / append_ops(cid, ops, history=None)
+#   commit_ops_versioned(cid, ops) -> (ops as written, version before, version after)
+#   append_messages(cid, messages, compact=True) for bulk loads
+#   open_pages(cid) -> object with .total, .next_id, .read(start, count), .batches(n)
+#   exists(cid) / version(cid)
+#   log_position() / changes_since(cid, position)
+#   list_conversations(limit, after=None) / set_title(cid, title)
+#
+# The backend is chosen with the CONVERSATION_STORAGE environment variable,
+# e.g. "sqlite:conversations.db" or "file:conversation_history.json", falling
+# back to the URL each app passes in.
+#
+# The catalog (list_conversations) pages through conversations, most recently
+# updated first, as {"id", "title", "count", "updated"} entries without
+# loading any of them; `after` is the catalog_cursor() of the last entry seen.
+# Untitled conversations show the start of their first message.
+#
+# Listeners registered with subscribe() are told about every change committed
+# through a storage object in this process.
+#
+# Backends that keep a change log let other processes catch up without a
+# reload: log_position() is the log's current end (None when the backend
+# keeps no log), and changes_since() returns the ops committed to a
+# conversation after a position, in commit order. A None entry means the
+# conversation was replaced wholesale.
+
+STORAGE_ENV = "CONVERSATION_STORAGE"
+DEFAULT_CONVERSATION = "default"
+MESSAGE_FIELDS = ("sender", "content")  # Fields an edit op may change
+CONVERSATIONS_DIR = "conversations"  # FileStorage shards, next to the default file
+TITLE_LENGTH = 60  # Characters of the first message used as a default title
+SESSION_LOG_PREFIX = "session_"  # Chainlit session logs, left out of the catalog
+CHANGE_LOG_SIZE = 100_000  # Changes kept in the SQLite change log
+CHANGE_LOG_PRUNE_EVERY = 1_000  # Commits between prunes of the change log
+
+_CONVERSATION_ID = re.compile(r"^[A-Za-z0-9_.-]+$")
+_storages = {}
+_storages_lock = threading.Lock()
+_listeners = []
+
+__all__ = [
+    "ConflictError", "add_op", "delete_op", "edit_op", "message_version", "replay",
+    "FileStorage", "SQLiteStorage", "open_storage", "subscribe",
+]
+
+
+def subscribe(listener):
+    # listener(storage, conversation_id, ops) runs after each commit; `ops` is
+    # None when the whole conversation was replaced.
+    _listeners.append(listener)
+
+
+def _notify(storage, conversation_id, ops):
+    for listener in list(_listeners):
+        listener(storage, conversation_id, ops)
+
+
+def check_conversation_id(conversation_id):
+    if not _CONVERSATION_ID.match(conversation_id) or conversation_id.startswith("."):
+        raise ValueError(f"Invalid conversation id: {conversation_id!r}")
+
+
+def catalog_cursor(entry):
+    return (entry["updated"], entry["id"])
+
+
+def _title(title, first_message, conversation_id):
+    if title:
+        return title
+    if first_message:
+        first_line = first_message.strip().splitlines()[0] if first_message.strip() else ""
+        if first_line:
+            return first_line[:TITLE_LENGTH]
+    return conversation_id
+
+
+class FileStorage:
+    # history_store journal files, one set per conversation. The default
+    # conversation lives at `path`; the others are sharded by a hash of their
+    # id under conversations/<xx>/<id>.json, so no directory grows past a few
+    # hundred entries. Conversations stored before sharding, as siblings of
+    # `path`, are still found there. A title is kept in `<id>.json.title`.
+
+    TITLE_SUFFIX = ".title"
+
+    def __init__(self, path):
+        self.path = path
+        self.directory = os.path.dirname(path)
+        self.shards = os.path.join(self.directory, CONVERSATIONS_DIR)
+
+    def path_for(self, conversation_id, create=False):
+        # Writers pass create=True so the shard directory exists
+        if conversation_id == DEFAULT_CONVERSATION:
+            return self.path
+        check_conversation_id(conversation_id)
+        legacy = os.path.join(self.directory, f"{conversation_id}.json")
+        if self._is_conversation(legacy):
+            return legacy
+        shard = os.path.join(self.shards, hashlib.sha1(conversation_id.encode()).hexdigest()[:2])
+        if create:
+            os.makedirs(shard, exist_ok=True)
+        return os.path.join(shard, f"{conversation_id}.json")
+
+    def _is_conversation(self, path):
+        # Only files with a history_store index or journal next to them; any
+        # other <id>.json (exports, package.json, the default file under its
+        # own name) is not a conversation
+        return os.path.abspath(path) != os.path.abspath(self.path) and (
+            os.path.exists(history_store.index_path(path)) or os.path.exists(history_store.journal_path(path))
+        )
+
+    def _conversations(self):
+        # id -> snapshot path for every stored conversation, from directory
+        # listings alone
+        found = {}
+        if history_store.exists(self.path):
+            found[DEFAULT_CONVERSATION] = self.path
+        suffixes = (".json" + history_store.INDEX_SUFFIX, ".json" + history_store.JOURNAL_SUFFIX)
+        directories = [self.directory or "."]
+        if os.path.isdir(self.shards):
+            directories += [os.path.join(self.shards, shard) for shard in os.listdir(self.shards)]
+        for directory in directories:
+            for name in os.listdir(directory):
+                for suffix in suffixes:
+                    if name.endswith(suffix):
+                        conversation_id = name[:-len(suffix)]
+                        path = os.path.join(directory, conversation_id + ".json")
+                        if (self._is_conversation(path)
+                                and _CONVERSATION_ID.match(conversation_id)
+                                and not conversation_id.startswith(SESSION_LOG_PREFIX)):
+                            found.setdefault(conversation_id, path)
+        return found
+
+    def _updated(self, path):
+        times = [os.stat(p).st_mtime for p in (path, history_store.journal_path(path)) if os.path.exists(p)]
+        return max(times, default=0.0)
+
+    def list_conversations(self, limit, after=None):
+        # Every conversation is stat()ed to sort the catalog, but only the
+        # returned page has its index opened for the count and title. Nothing
+        # is written: a snapshot from before indexing is read whole instead.
+        keys = sorted(
+            ((self._updated(path), conversation_id) for conversation_id, path in self._conversations().items()),
+            reverse=True,
+        )
+        if after is not None:
+            keys = [key for key in keys if key < tuple(after)]
+        entries = []
+        for updated, conversation_id in keys[:limit]:
+            pages = history_store.open_pages(self.path_for(conversation_id), rewrite=False)
+            if pages is not None:
+                count, first = pages.total, pages.read(0, 1) if pages.total else []
+            else:
+                history = self.load_history(conversation_id) or []
+                count, first = len(history), history[:1]
+            try:
+                with open(self.path_for(conversation_id) + self.TITLE_SUFFIX) as f:
+                    title = f.read()
+            except FileNotFoundError:
+                title = None
+            entries.append({
+                "id": conversation_id,
+                "title": _title(title, first[0]["content"] if first else None, conversation_id),
+                "count": count,
+                "updated": updated,
+            })
+        return entries, len(keys) > limit
+
+    def set_title(self, conversation_id, title):
+        path = self.path_for(conversation_id, create=True) + self.TITLE_SUFFIX
+        with open(path + ".tmp", "w") as f:
+            f.write(title)
+        os.replace(path + ".tmp", path)
+
+    def exists(self, conversation_id):
+        return history_store.exists(self.path_for(conversation_id))
+
+    def version(self, conversation_id):
+        return history_store.version(self.path_for(conversation_id))
+
+    def log_position(self):
+        # No change log; readers compare version() and reload instead
+        return None
+
+    @metrics.timed("load_history")
+    def load_history(self, conversation_id):
+        return history_store.load_history(self.path_for(conversation_id))
+
+    @metrics.timed("save_history")
+    def save_history(self, conversation_id, history):
+        history_store.save_history(self.path_for(conversation_id, create=True), history)
+        _notify(self, conversation_id, None)
+
+    @metrics.timed("commit_ops")
+    def commit_ops(self, conversation_id, ops, history=None):
+        prepared = history_store.commit_ops(self.path_for(conversation_id, create=True), ops, history)
+        _notify(self, conversation_id, prepared)
+        return prepared
+
+    @metrics.timed("commit_ops")
+    def commit_ops_versioned(self, conversation_id, ops):
+        prepared, before, after = history_store.commit_ops_versioned(self.path_for(conversation_id, create=True), ops)
+        _notify(self, conversation_id, prepared)
+        return prepared, before, after
+
+    @metrics.timed("append_ops")
+    def append_ops(self, conversation_id, ops, history=None):
+        prepared = history_store.append_ops(self.path_for(conversation_id, create=True), ops, history)
+        _notify(self, conversation_id, prepared)
+        return prepared
+
+    @metrics.timed("append_messages")
+    def append_messages(self, conversation_id, messages, compact=True):
+        ops = [add_op(message) for message in messages]
+        prepared = history_store.commit_ops(self.path_for(conversation_id, create=True), ops, history=[], compact=compact)
+        _notify(self, conversation_id, prepared)
+        return prepared
+
+    @metrics.timed("open_pages")
+    def open_pages(self, conversation_id):
+        return history_store.open_pages(self.path_for(conversation_id))
+
+
+class SQLitePages:
+    # Same interface as history_store.HistoryPages, backed by indexed queries.
+
+    def __init__(self, storage, conversation_id):
+        self._storage = storage
+        self._conversation_id = conversation_id
+        db = storage._connection()
+        self.total, max_id = db.execute(
+            "SELECT COUNT(*), COALESCE(MAX(id), 0) FROM messages WHERE conversation_id = ?",
+            (conversation_id,),
+        ).fetchone()
+        self.next_id = max_id + 1
+
+    @metrics.timed("read_page")
+    def read(self, start, count):
+        rows = self._storage._connection().execute(
+            "SELECT id, sender, content, version FROM messages WHERE conversation_id = ?"
+            " ORDER BY ordinal LIMIT ? OFFSET ?",
+            (self._conversation_id, count, start),
+        )
+        return [_message(row) for row in rows]
+
+    def batches(self, batch_size):
+        # Keyset pagination, so each batch is an index seek rather than an OFFSET scan
+        db = self._storage._connection()
+        after = -1
+        while True:
+            rows = db.execute(
+                "SELECT id, sender, content, version, ordinal FROM messages"
+                " WHERE conversation_id = ? AND ordinal > ? ORDER BY ordinal LIMIT ?",
+                (self._conversation_id, after, batch_size),
+            ).fetchall()
+            if not rows:
+                return
+            yield [_message(row) for row in rows]
+            after = rows[-1][4]
+
+
+def _message(row):
+    return {"id": row[0], "sender": row[1], "content": row[2], "version": row[3]}
+
+
+class SQLiteStorage:
+    # One database for every conversation, in WAL mode so readers never block
+    # the writer. Messages are keyed by (conversation_id, id) and ordered by a
+    # per-conversation ordinal. Every commit also appends its ops to the
+    # change log in the same transaction, so the log's order is commit order.
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL DEFAULT 0,
+            title TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            conversation_id TEXT NOT NULL REFERENCES conversations (id),
+            id INTEGER NOT NULL,
+            ordinal INTEGER NOT NULL,
+            sender TEXT NOT NULL,
+            content TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (conversation_id, id)
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS messages_by_ordinal ON messages (conversation_id, ordinal);
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT NOT NULL,
+            ops TEXT
+        );
+        CREATE INDEX IF NOT EXISTS changes_by_conversation ON changes (conversation_id, seq);
+    """
+
+    # Catalog columns added to databases created before the catalog existed
+    CATALOG_COLUMNS = {
+        "title": "TEXT",
+        "message_count": "INTEGER NOT NULL DEFAULT 0",
+        "updated_at": "REAL NOT NULL DEFAULT 0",
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        db = self._connection()
+        db.executescript(self.SCHEMA)
+        columns = {row[1] for row in db.execute("PRAGMA table_info(conversations)")}
+        missing = {name: kind for name, kind in self.CATALOG_COLUMNS.items() if name not in columns}
+        if missing:
+            with self._transaction() as db:
+                for name, kind in missing.items():
+                    db.execute(f"ALTER TABLE conversations ADD COLUMN {name} {kind}")
+                db.execute(
+                    "UPDATE conversations SET message_count ="
+                    " (SELECT COUNT(*) FROM messages WHERE conversation_id = conversations.id)"
+                )
+        db.execute("CREATE INDEX IF NOT EXISTS conversations_by_updated ON conversations (updated_at, id)")
+
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _generation(self, db, conversation_id):
+        row = db.execute("SELECT generation FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        return row[0] if row else None
+
+    def _touch(self, db, conversation_id):
+        db.execute(
+            "INSERT INTO conversations (id, generation, updated_at) VALUES (?, 1, ?)"
+            " ON CONFLICT (id) DO UPDATE SET generation = generation + 1, updated_at = excluded.updated_at",
+            (conversation_id, time.time()),
+        )
+
+    def _count(self, db, conversation_id, delta=None):
+        # Keeps the catalog's message count: adjusted by `delta`, or recounted
+        if delta is None:
+            db.execute(
+                "UPDATE conversations SET message_count ="
+                " (SELECT COUNT(*) FROM messages WHERE conversation_id = ?) WHERE id = ?",
+                (conversation_id, conversation_id),
+            )
+        elif delta:
+            db.execute(
+                "UPDATE conversations SET message_count = message_count + ? WHERE id = ?",
+                (delta, conversation_id),
+            )
+
+    def _log(self, db, conversation_id, ops):
+        # ops=None records that the whole conversation was replaced
+        seq = db.execute(
+            "INSERT INTO changes (conversation_id, ops) VALUES (?, ?)",
+            (conversation_id, None if ops is None else json.dumps(ops)),
+        ).lastrowid
+        if seq % CHANGE_LOG_PRUNE_EVERY == 0:
+            db.execute("DELETE FROM changes WHERE seq <= ?", (seq - CHANGE_LOG_SIZE,))
+
+    def _insert(self, db, conversation_id, messages, first_ordinal):
+        db.executemany(
+            "INSERT INTO messages (conversation_id, id, ordinal, sender, content, version)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (conversation_id, m["id"], ordinal, m["sender"], m["content"], message_version(m))
+                for ordinal, m in enumerate(messages, start=first_ordinal)
+            ),
+        )
+
+    def exists(self, conversation_id):
+        row = self._connection().execute(
+            "SELECT 1 FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        return row is not None
+
+    def version(self, conversation_id):
+        row = self._connection().execute(
+            "SELECT generation FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def log_position(self):
+        (seq,) = self._connection().execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()
+        return seq
+
+    def changes_since(self, conversation_id, position):
+        # (new position, [(seq, ops), ...]); the list is None when the log has
+        # been pruned past `position`, and the caller has to reload. Both reads
+        # come from one snapshot so nothing committed between them is skipped.
+        db = self._connection()
+        db.execute("BEGIN")
+        try:
+            oldest, newest = db.execute("SELECT MIN(seq), COALESCE(MAX(seq), 0) FROM changes").fetchone()
+            if oldest is not None and position < oldest - 1:
+                return newest, None
+            rows = db.execute(
+                "SELECT seq, ops FROM changes WHERE conversation_id = ? AND seq > ? ORDER BY seq",
+                (conversation_id, position),
+            ).fetchall()
+        finally:
+            db.execute("COMMIT")
+        return newest, [(seq, None if ops is None else json.loads(ops)) for seq, ops in rows]
+
+    def list_conversations(self, limit, after=None):
+        # Keyset page over the (updated_at, id) index; the default title is a
+        # lookup of each listed conversation's first ordinal.
+        query = (
+            "SELECT id, title, message_count, updated_at,"
+            " (SELECT content FROM messages WHERE conversation_id = conversations.id ORDER BY ordinal LIMIT 1)"
+            " FROM conversations"
+        )
+        query += " WHERE id NOT LIKE ? ESCAPE '\\'"
+        params = [SESSION_LOG_PREFIX.replace("_", "\\_") + "%"]
+        if after is not None:
+            query += " AND (updated_at, id) < (?, ?)"
+            params += list(after)
+        query += " ORDER BY updated_at DESC, id DESC LIMIT ?"
+        rows = self._connection().execute(query, (*params, limit + 1)).fetchall()
+        entries = [
+            {"id": row[0], "title": _title(row[1], row[4], row[0]), "count": row[2], "updated": row[3]}
+            for row in rows[:limit]
+        ]
+        return entries, len(rows) > limit
+
+    def set_title(self, conversation_id, title):
+        with self._transaction() as db:
+            self._touch(db, conversation_id)
+            db.execute("UPDATE conversations SET title = ? WHERE id = ?", (title, conversation_id))
+
+    @metrics.timed("load_history")
+    def load_history(self, conversation_id):
+        if not self.exists(conversation_id):
+            return None
+        rows = self._connection().execute(
+            "SELECT id, sender, content, version FROM messages WHERE conversation_id = ? ORDER BY ordinal",
+            (conversation_id,),
+        )
+        return [_message(row) for row in rows]
+
+    @metrics.timed("save_history")
+    def save_history(self, conversation_id, history):
+        with self._transaction() as db:
+            self._touch(db, conversation_id)
+            db.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            self._insert(db, conversation_id, history, 0)
+            self._count(db, conversation_id)
+            self._log(db, conversation_id, None)
+        _notify(self, conversation_id, None)
+
+    @metrics.timed("commit_ops")
+    def commit_ops(self, conversation_id, ops, history=None):
+        return self._commit_ops(conversation_id, ops, history)[0]
+
+    @metrics.timed("commit_ops")
+    def commit_ops_versioned(self, conversation_id, ops):
+        return self._commit_ops(conversation_id, ops, None)
+
+    def _commit_ops(self, conversation_id, ops, history):
+        # (ops as written, generation before, generation after)
+        with self._transaction() as db:
+            seed = history is not None and not self.exists(conversation_id)
+            before = self._generation(db, conversation_id)
+            self._touch(db, conversation_id)
+            if seed:
+                self._insert(db, conversation_id, history, 0)
+                self._count(db, conversation_id)
+                self._log(db, conversation_id, None)
+            prepared = []
+            conflicts = []
+            for op in ops:
+                kind = op["op"]
+                if kind == "add":
+                    message = {**op["message"], "version": 1}
+                    (ordinal,) = db.execute(
+                        "SELECT COALESCE(MAX(ordinal), -1) + 1 FROM messages WHERE conversation_id = ?",
+                        (conversation_id,),
+                    ).fetchone()
+                    try:
+                        self._insert(db, conversation_id, [message], ordinal)
+                    except sqlite3.IntegrityError:
+                        conflicts.append(message["id"])
+                        continue
+                    prepared.append(add_op(message))
+                    continue
+                row = db.execute(
+                    "SELECT version FROM messages WHERE conversation_id = ? AND id = ?",
+                    (conversation_id, op["id"]),
+                ).fetchone()
+                if row is None or op.get("base", row[0]) != row[0]:
+                    conflicts.append(op["id"])
+                    continue
+                if kind == "edit":
+                    fields = {k: v for k, v in op["fields"].items() if k in MESSAGE_FIELDS}
+                    assignments = "".join(f"{name} = ?, " for name in fields)
+                    db.execute(
+                        f"UPDATE messages SET {assignments}version = ? WHERE conversation_id = ? AND id = ?",
+                        (*fields.values(), row[0] + 1, conversation_id, op["id"]),
+                    )
+                    prepared.append({**op, "version": row[0] + 1})
+                else:
+                    db.execute(
+                        "DELETE FROM messages WHERE conversation_id = ? AND id = ?",
+                        (conversation_id, op["id"]),
+                    )
+                    prepared.append(op)
+            if conflicts:
+                raise ConflictError(conflicts)
+            self._count(db, conversation_id, sum(
+                1 if op["op"] == "add" else -1 if op["op"] == "delete" else 0 for op in prepared
+            ))
+            self._log(db, conversation_id, prepared)
+            after = self._generation(db, conversation_id)
+        _notify(self, conversation_id, prepared)
+        return prepared, before, after
+
+    @metrics.timed("append_ops")
+    def append_ops(self, conversation_id, ops, history=None):
+        if history is not None and not self.exists(conversation_id):
+            self.save_history(conversation_id, history)
+            return None
+        try:
+            return self.commit_ops(conversation_id, ops)
+        except ConflictError:
+            return []
+
+    @metrics.timed("append_messages")
+    def append_messages(self, conversation_id, messages, compact=True):
+        # One multi-row insert after the current last ordinal, rather than an
+        # ordinal lookup per message
+        messages = [{**message, "version": 1} for message in messages]
+        with self._transaction() as db:
+            self._touch(db, conversation_id)
+            (ordinal,) = db.execute(
+                "SELECT COALESCE(MAX(ordinal), -1) + 1 FROM messages WHERE conversation_id = ?",
+                (conversation_id,),
+            ).fetchone()
+            try:
+                self._insert(db, conversation_id, messages, ordinal)
+            except sqlite3.IntegrityError:
+                ids = [m["id"] for m in messages]
+                taken = {row[0] for row in db.execute(
+                    "SELECT id FROM messages WHERE conversation_id = ? AND id BETWEEN ? AND ?",
+                    (conversation_id, min(ids), max(ids)),
+                )}
+                raise ConflictError([i for i in ids if i in taken])
+            prepared = [add_op(message) for message in messages]
+            self._count(db, conversation_id, len(messages))
+            self._log(db, conversation_id, prepared)
+        _notify(self, conversation_id, prepared)
+        return prepared
+
+    @metrics.timed("open_pages")
+    def open_pages(self, conversation_id):
+        if not self.exists(conversation_id):
+            return None
+        return SQLitePages(self, conversation_id)
+
+
+def open_storage(default_url):
+    url = os.environ.get(STORAGE_ENV, default_url)
+    with _storages_lock:
+        if url not in _storages:
+            scheme, _, location = url.partition(":")
+            if scheme == "file":
+                _storages[url] = FileStorage(location)
+            elif scheme == "sqlite":
+                _storages[url] = SQLiteStorage(location)
+            else:
+                raise ValueError(f"Unknown conversation storage: {url}")
+        return _storages[url]
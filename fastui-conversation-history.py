@@ -3,67 +3,443 @@ from fastui.components.display import DisplayMode, DisplayLookup
 from fastui.events import GoToEvent, BackEvent
 from fastui.forms import FastUIForm
 from fastui.components.links import navigate
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List
+from collections import deque
+from typing import AsyncIterator, Callable, Iterable, Iterator, List, Optional
+import asyncio
+import base64
+import binascii
 import csv
+import json
+import time
+import zlib
+import threading
+import uuid
+from collections import OrderedDict
 from io import StringIO
+from urllib.parse import urlencode
+from message_store import MessageStore
+import change_feed
+import conversation_storage
+import history_import
+import history_search
+import metrics
 
 app = FastAPI()
 ui = FastUI(app)
 
+CSV_CHUNK_SIZE = 64 * 1024  # Bytes of CSV buffered before a chunk is sent
+HISTORY_FILE = "conversation_history.json"
+CONVERSATION_ID = conversation_storage.DEFAULT_CONVERSATION
+PAGE_SIZE = 20  # Table rows per page on /
+RENDER_CACHE_SIZE = 256  # Rendered pages kept, across all versions
+ETAG_SEED = uuid.uuid4().hex[:8]  # Keeps ETags from before a restart from matching
+FEED_POLL_SECONDS = 0.5  # How often the process checks the feed for change streams
+FEED_KEEPALIVE_SECONDS = 15  # Comment lines keep idle streams open through proxies
+LIVE_CHANGES_SHOWN = 5  # Recent changes listed in the live panel on /
+CATALOG_PAGE_SIZE = 20  # Conversations per page of the catalog
+OPEN_CONVERSATIONS = 16  # Conversations kept loaded in memory
+BATCH_ACTIONS = {"delete": "🗑️ Delete", "sender": "👤 Reassign sender", "replace": "🔁 Replace in content"}
+
 class Message(BaseModel):
     id: int
     sender: str
     content: str
+    version: int = 1
 
-class ConversationState(BaseModel):
-    messages: List[Message] = [
-        Message(id=1, sender="User", content="Write a Python function to calculate factorial."),
-        Message(id=2, sender="Coder", content="Here's a Python function to calculate factorial:"),
-        Message(id=3, sender="Coder", content="def factorial(n):\n    if n == 0 or n == 1:\n        return 1\n    else:\n        return n * factorial(n-1)"),
-        Message(id=4, sender="User", content="Execution result: Success"),
-        Message(id=5, sender="Coder", content="Great! The factorial function has been implemented successfully. You can now use this function to calculate factorials. For example, factorial(5) would return 120."),
-    ]
+SEED_MESSAGES = [
+    Message(id=1, sender="User", content="Write a Python function to calculate factorial."),
+    Message(id=2, sender="Coder", content="Here's a Python function to calculate factorial:"),
+    Message(id=3, sender="Coder", content="def factorial(n):\n    if n == 0 or n == 1:\n        return 1\n    else:\n        return n * factorial(n-1)"),
+    Message(id=4, sender="User", content="Execution result: Success"),
+    Message(id=5, sender="Coder", content="Great! The factorial function has been implemented successfully. You can now use this function to calculate factorials. For example, factorial(5) would return 120."),
+]
+
+# Sort orders for the conversation table; keys end with the id so each one is
+# unique and can serve as a keyset cursor
+SORT_ORDERS = {
+    "id": lambda m: (m.id,),
+    "sender": lambda m: (m.sender, m.id),
+}
+# The types in each sort order's key, to check cursors that come back in URLs
+SORT_KEY_TYPES = {
+    "id": (int,),
+    "sender": (str, int),
+}
+CATALOG_KEY_TYPES = ((int, float), str)  # conversation_storage.catalog_cursor()
+
+def encode_cursor(key: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+def decode_cursor(cursor: str, types: tuple) -> Optional[tuple]:
+    # A cursor that isn't a key of this shape (edited by hand, or carried over
+    # from another sort order) is a bad request, not something to compare
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, binascii.Error):
+        key = None
+    if (not isinstance(key, list) or len(key) != len(types)
+            or any(isinstance(k, bool) or not isinstance(k, t) for k, t in zip(key, types))):
+        raise HTTPException(status_code=400, detail="Invalid page cursor")
+    return tuple(key)
+
+class ConversationState:
+    # Reads are served from the in-memory MessageStore; every change is written
+    # through to the shared conversation storage as a single op. Changes made
+    # by other workers and apps are picked up on the next read: from the
+    # storage's change log when it keeps one (SQLite), otherwise by reloading
+    # when the storage version has moved.
+    def __init__(self, storage, conversation_id):
+        self.storage = storage
+        self.conversation_id = conversation_id
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.reload()
+
+    def reload(self):
+        with self._lock:
+            self.generation += 1
+            # Taken before the load: changes committed in between are replayed
+            # (or reloaded) on the next refresh, and replaying is idempotent
+            self._position = self.storage.log_position()
+            self._version = self.storage.version(self.conversation_id)
+            history = self.storage.load_history(self.conversation_id)
+            if history is None:
+                seed = SEED_MESSAGES if self.conversation_id == CONVERSATION_ID else []
+                history = [m.model_dump() for m in seed]
+                self.storage.save_history(self.conversation_id, history)
+                self._position = self.storage.log_position()
+                self._version = None  # Compared on the next refresh, which reloads the seed once
+            self.messages: MessageStore[Message] = MessageStore((Message(**m) for m in history), indexes=SORT_ORDERS)
+
+    def refresh(self):
+        if self._position is None:
+            if self.storage.version(self.conversation_id) != self._version:
+                self.reload()
+            return
+        position, changes = self.storage.changes_since(self.conversation_id, self._position)
+        if changes is None or any(ops is None for _, ops in changes):
+            self.reload()
+            return
+        with self._lock:
+            for _, ops in changes:
+                for op in ops:
+                    self._apply(op)
+            self._position = max(self._position, position)
+
+    def _apply(self, op: dict):
+        # Ops this process committed itself come back through the log too, so
+        # anything already applied is skipped
+        message_id = op["message"]["id"] if op["op"] == "add" else op["id"]
+        message = self.messages.get(message_id)
+        if op["op"] == "add":
+            if message is None:
+                self.messages.add(Message(**op["message"]))
+        elif op["op"] == "edit":
+            if message is not None and op["version"] > message.version:
+                fields = {k: v for k, v in op["fields"].items() if k in conversation_storage.MESSAGE_FIELDS}
+                self.messages.update(message_id, version=op["version"], **fields)
+        elif message is not None:
+            self.messages.delete(message_id)
+
+    def etag(self, message_id: Optional[int] = None) -> str:
+        # Changes with every change to the conversation (or to one message)
+        # this process sees; a reload starts a new generation. With a change
+        # log the conversation's tag is its log position, which every worker
+        # agrees on.
+        if message_id is None:
+            if self._position is not None:
+                return f'"{self.conversation_id}.{self._position}"'
+            return f'"{ETAG_SEED}.{self.generation}.{self.messages.version}"'
+        message = self.messages.get(message_id)
+        return f'"{ETAG_SEED}.{self.generation}.{message_id}.{message.version if message else 0}"'
+
+    def page(self, sort: str, limit: int, after=None, before=None, where=None):
+        with self._lock:
+            return self.messages.page(sort, limit, after=after, before=before, where=where)
+
+    def _commit(self, *ops):
+        # All ops are written in one commit, or none are
+        if not ops:
+            return []
+        try:
+            committed, before, after = self.storage.commit_ops_versioned(self.conversation_id, list(ops))
+        except conversation_storage.ConflictError:
+            self._version = None  # Someone else changed it first; reload on next read
+            raise
+        # Versions observed under the storage's lock: only if nobody wrote
+        # since our copy was current is it current now; otherwise the next
+        # refresh reloads.
+        if before is not None and before == self._version:
+            self._version = after
+        return committed
+
+    def add_message(self, sender: str, content: str) -> Message:
+        with self._lock:
+            message = Message(id=self.messages.allocate_id(), sender=sender, content=content)
+            (committed,) = self._commit(conversation_storage.add_op(message.model_dump()))
+            return self.messages.add(Message(**committed["message"]))
+
+    def edit_message(self, id: int, **fields) -> Optional[Message]:
+        with self._lock:
+            message = self.messages.get(id)
+            if message is None:
+                return None
+            (committed,) = self._commit(conversation_storage.edit_op(id, base_version=message.version, **fields))
+            return self.messages.update(id, version=committed["version"], **fields)
+
+    def delete_message(self, id: int) -> bool:
+        with self._lock:
+            message = self.messages.get(id)
+            if message is None:
+                return False
+            self._commit(conversation_storage.delete_op(id, base_version=message.version))
+            return self.messages.delete(id)
+
+    def _selected(self, ids: Iterable[int]) -> List[Message]:
+        return [message for message in map(self.messages.get, dict.fromkeys(ids)) if message is not None]
+
+    def delete_messages(self, ids: Iterable[int]) -> int:
+        # Ids that are already gone are skipped; returns how many were deleted
+        with self._lock:
+            messages = self._selected(ids)
+            self._commit(*(conversation_storage.delete_op(m.id, base_version=m.version) for m in messages))
+            for message in messages:
+                self.messages.delete(message.id)
+            return len(messages)
 
-state = ConversationState()
+    def edit_messages(self, ids: Iterable[int], edit: Callable[[Message], dict]) -> int:
+        # edit(message) returns the fields to change, or {} to leave the
+        # message alone; returns how many messages changed
+        with self._lock:
+            changes = [(message, edit(message)) for message in self._selected(ids)]
+            changes = [(message, fields) for message, fields in changes if fields]
+            committed = self._commit(*(
+                conversation_storage.edit_op(message.id, base_version=message.version, **fields)
+                for message, fields in changes
+            ))
+            for (message, fields), op in zip(changes, committed):
+                self.messages.update(message.id, version=op["version"], **fields)
+            return len(changes)
+
+class OpenConversations:
+    # A conversation's messages are only loaded when it is first opened; past
+    # max_open, the least recently used conversation is dropped from memory.
+    def __init__(self, storage, max_open: int):
+        self.storage = storage
+        self.max_open = max_open
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id: str) -> ConversationState:
+        with self._lock:
+            state = self._states.get(conversation_id)
+            if state is not None:
+                self._states.move_to_end(conversation_id)
+                return state
+        if conversation_id != CONVERSATION_ID:
+            try:
+                conversation_storage.check_conversation_id(conversation_id)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            if not self.storage.exists(conversation_id):
+                raise HTTPException(status_code=404, detail=f"No conversation {conversation_id!r}")
+        state = ConversationState(self.storage, conversation_id)  # Loaded outside the lock
+        with self._lock:
+            state = self._states.setdefault(conversation_id, state)
+            self._states.move_to_end(conversation_id)
+            while len(self._states) > self.max_open:
+                self._states.popitem(last=False)
+        return state
+
+storage = conversation_storage.open_storage(f"file:{HISTORY_FILE}")
+feed = change_feed.open_feed(storage)
+conversations = OpenConversations(storage, OPEN_CONVERSATIONS)
+
+def url(path: str, conversation: str, **params) -> str:
+    # Links within a conversation carry its id; the default one's URLs are
+    # unchanged
+    if conversation != CONVERSATION_ID:
+        params = {'conversation': conversation, **params}
+    return path + ('?' + urlencode(params) if params else '')
+
+@app.middleware("http")
+async def time_handlers(request: Request, call_next):
+    # One latency histogram per page/API handler, labelled by route rather
+    # than URL so ids don't explode the label set
+    start = time.perf_counter()
+    response = await call_next(request)
+    endpoint = request.scope.get("endpoint")
+    name = endpoint.__name__ if endpoint is not None else "unmatched"
+    metrics.observe(f"{request.method} {name}", time.perf_counter() - start)
+    return response
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+class RenderCache:
+    # Rendered component trees keyed by page, parameters and ETag; entries for
+    # old versions are simply never asked for again and age out.
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+rendered = RenderCache(RENDER_CACHE_SIZE)
+
+def not_modified(request: Request, etag: str) -> bool:
+    tags = {tag.strip().removeprefix('W/') for tag in request.headers.get('if-none-match', '').split(',')}
+    return etag in tags or '*' in tags
+
+def check_etag(request: Request, response: Response, etag: str) -> str:
+    # Answers If-None-Match with 304 before anything is rendered
+    if not_modified(request, etag):
+        raise HTTPException(status_code=304, headers={'ETag': etag})
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'no-cache'
+    return etag
+
+def conflict() -> HTTPException:
+    return HTTPException(status_code=409, detail="The conversation was changed by someone else; reload and try again.")
 
 @ui.page('/')
-def conversation_history() -> List[AnyComponent]:
-    return [
+def conversation_history(request: Request, response: Response, conversation: str = CONVERSATION_ID, sort: str = 'id',
+                         sender: str = '', q: str = '', after: str = '', before: str = '') -> List[AnyComponent]:
+    # One page of rows per request, found by seeking the sort index to the
+    # cursor; the cursor is the sort key of the row the page continues from.
+    state = conversations.get(conversation)
+    state.refresh()
+    key = ('/', conversation, sort, sender, q, after, before, check_etag(request, response, state.etag()))
+    page = rendered.get(key)
+    if page is not None:
+        return page
+    if sort not in SORT_ORDERS:
+        sort = 'id'
+    text = q.lower()
+
+    def matches(message: Message) -> bool:
+        return (not sender or message.sender == sender) and (not text or text in message.content.lower())
+
+    key_types = SORT_KEY_TYPES[sort]
+    rows, more = state.page(
+        sort, PAGE_SIZE, after=decode_cursor(after, key_types), before=decode_cursor(before, key_types),
+        where=matches if sender or text else None,
+    )
+    has_previous = more if before else bool(after)
+    has_next = more if not before else True
+    filters = {name: value for name, value in (('sort', sort), ('sender', sender), ('q', q)) if value}
+
+    def page_link(label: str, **cursor) -> AnyComponent:
+        return c.Link(components=[c.Text(text=label)], on_click=GoToEvent(url=url('/', conversation, **filters, **cursor)))
+
+    navigation = []
+    if rows and has_previous:
+        navigation.append(page_link("← Previous", before=encode_cursor(SORT_ORDERS[sort](rows[0]))))
+    if rows and has_next:
+        navigation.append(page_link("Next →", after=encode_cursor(SORT_ORDERS[sort](rows[-1]))))
+    if not rows and (after or before):
+        navigation.append(page_link("First page"))
+
+    return rendered.put(key, [
         c.Page(
             components=[
                 c.Heading(text="Conversation History", level=1),
+                c.Link(components=[c.Text(text="📚 All conversations")], on_click=GoToEvent(url='/conversations')),
+                c.Form(
+                    form_fields=[
+                        *([c.TextInput(name="conversation", label="Conversation", initial=conversation)]
+                          if conversation != CONVERSATION_ID else []),
+                        c.Select(name="sort", label="Sort by", options=list(SORT_ORDERS), initial=sort),
+                        c.TextInput(name="sender", label="Sender", initial=sender),
+                        c.TextInput(name="q", label="Content contains", initial=q),
+                    ],
+                    submit_url="/",
+                    method="GOTO",
+                    submit_button_text="Apply",
+                ),
+                c.Paragraph(text=f"{len(state.messages)} messages in total"),
                 c.Table(
-                    data=state.messages,
+                    data=rows,
+                    data_model=Message,
                     columns=[
+                        DisplayLookup(field='id', header='Id'),
                         DisplayLookup(field='sender', header='Sender'),
                         DisplayLookup(field='content', header='Content'),
                     ],
                     actions=[
                         c.Button(
                             text="✏️ Edit",
-                            on_click=navigate(f'/edit/{{item.id}}'),
+                            on_click=navigate(url('/edit/{item.id}', conversation)),
                         ),
                         c.Button(
                             text="🗑️ Delete",
                             on_click=c.FireEvent(name='delete', payload={'id': '{{item.id}}'}),
                         ),
                     ],
-                ),
-                c.Button(text="➕ Add New Message", on_click=navigate('/add')),
-                c.Button(text="📁 Export to CSV", on_click=navigate('/export')),
+                ) if rows else c.Paragraph(text="No messages match."),
+                c.Div(components=navigation),
+                c.ServerLoad(path=url('/changes/live', conversation), sse=True),
+                *([c.Form(
+                    form_fields=[
+                        c.Select(
+                            name="ids", label="Selected messages", multiple=True,
+                            options=[{"value": str(m.id), "label": f"{m.id} · {m.sender}: {m.content[:60]}"} for m in rows],
+                        ),
+                        c.Select(
+                            name="action", label="Action", initial="delete",
+                            options=[{"value": action, "label": label} for action, label in BATCH_ACTIONS.items()],
+                        ),
+                        c.TextInput(name="sender", label="New sender"),
+                        c.TextInput(name="find", label="Find in content"),
+                        c.TextInput(name="replace", label="Replace with"),
+                    ],
+                    submit_url=url('/api/batch', conversation),
+                    submit_button_text="Apply to selected",
+                )] if rows else []),
+                c.Button(text="➕ Add New Message", on_click=navigate(url('/add', conversation))),
+                c.Button(text="🔍 Search", on_click=navigate(url('/search', conversation))),
+                c.Button(text="📁 Export to CSV", on_click=navigate(url('/export', conversation))),
+                c.Button(text="📥 Import", on_click=navigate(url('/import', conversation))),
             ]
         )
-    ]
+    ])
 
 @ui.page('/edit/{id:int}')
-def edit_message(id: int) -> List[AnyComponent]:
-    message = next((m for m in state.messages if m.id == id), None)
+def edit_message(id: int, request: Request, response: Response, conversation: str = CONVERSATION_ID) -> List[AnyComponent]:
+    # Keyed to this message's version, so edits elsewhere in the conversation
+    # don't invalidate it.
+    state = conversations.get(conversation)
+    state.refresh()
+    key = ('/edit', conversation, id, check_etag(request, response, state.etag(id)))
+    page = rendered.get(key)
+    if page is not None:
+        return page
+    message = state.messages.get(id)
     if not message:
         return [c.Paragraph(text="Message not found")]
     
-    return [
+    return rendered.put(key, [
         c.Page(
             components=[
                 c.Heading(text=f"Edit Message {id}", level=2),
@@ -72,16 +448,16 @@ def edit_message(id: int) -> List[AnyComponent]:
                         c.TextInput(name="sender", label="Sender", initial=message.sender),
                         c.TextArea(name="content", label="Content", initial=message.content),
                     ],
-                    submit_url=f"/api/edit/{id}",
+                    submit_url=url(f"/api/edit/{id}", conversation),
                     submit_button_text="💾 Save Changes",
                 ),
                 c.Button(text="↩️ Back", on_click=BackEvent()),
             ]
         )
-    ]
+    ])
 
 @ui.page('/add')
-def add_message() -> List[AnyComponent]:
+def add_message(conversation: str = CONVERSATION_ID) -> List[AnyComponent]:
     return [
         c.Page(
             components=[
@@ -91,7 +467,7 @@ def add_message() -> List[AnyComponent]:
                         c.Select(name="sender", label="Sender", options=["User", "Coder"]),
                         c.TextArea(name="content", label="Content"),
                     ],
-                    submit_url="/api/add",
+                    submit_url=url('/api/add', conversation),
                     submit_button_text="➕ Add Message",
                 ),
                 c.Button(text="↩️ Back", on_click=BackEvent()),
@@ -99,19 +475,143 @@ def add_message() -> List[AnyComponent]:
         )
     ]
 
-@ui.page('/export')
-def export_csv() -> List[AnyComponent]:
-    csv_content = generate_csv()
+class SearchHit(BaseModel):
+    id: int
+    sender: str
+    snippet: str
+
+@ui.page('/search')
+def search_messages(q: str = '', conversation: str = CONVERSATION_ID) -> List[AnyComponent]:
+    state = conversations.get(conversation)
+    hits = []
+    if q:
+        results = history_search.index_for(state.storage, state.conversation_id).search(q)
+        hits = [SearchHit(id=r.message_id, sender=r.sender, snippet=r.snippet) for r in results]
     return [
+        c.Page(
+            components=[
+                c.Heading(text="Search Messages", level=2),
+                c.Form(
+                    form_fields=[
+                        *([c.TextInput(name="conversation", label="Conversation", initial=conversation)]
+                          if conversation != CONVERSATION_ID else []),
+                        c.TextInput(name="q", label="Search", initial=q),
+                    ],
+                    submit_url="/search",
+                    method="GOTO",
+                    submit_button_text="🔍 Search",
+                ),
+                c.Table(
+                    data=hits,
+                    data_model=SearchHit,
+                    columns=[
+                        DisplayLookup(field='id', header='Message'),
+                        DisplayLookup(field='sender', header='Sender'),
+                        DisplayLookup(field='snippet', header='Match', mode=DisplayMode.markdown),
+                    ],
+                    actions=[
+                        c.Button(
+                            text="✏️ Edit",
+                            on_click=navigate(url('/edit/{item.id}', conversation)),
+                        ),
+                    ],
+                ) if hits else c.Paragraph(text="No matching messages." if q else "Enter words to search for."),
+                c.Button(text="↩️ Back to Conversation", on_click=navigate(url('/', conversation))),
+            ]
+        )
+    ]
+
+@ui.page('/export')
+def export_csv(request: Request, response: Response, conversation: str = CONVERSATION_ID) -> List[AnyComponent]:
+    # Never changes while the process runs
+    key = ('/export', conversation, check_etag(request, response, f'"{ETAG_SEED}.export"'))
+    page = rendered.get(key)
+    if page is not None:
+        return page
+    return rendered.put(key, [
         c.Page(
             components=[
                 c.Heading(text="Export Conversation History", level=2),
                 c.Paragraph(text="Click the button below to download the conversation history as a CSV file."),
-                c.DownloadButton(
-                    text="⬇️ Download CSV",
-                    filename="conversation_history.csv",
-                    data=csv_content,
-                    mime="text/csv",
+                c.Link(
+                    components=[c.Text(text="⬇️ Download CSV")],
+                    on_click=GoToEvent(url=url('/api/export.csv', conversation), target='_blank'),
+                ),
+                c.Button(text="↩️ Back to Conversation", on_click=navigate(url('/', conversation))),
+            ]
+        )
+    ])
+
+@ui.page('/import')
+def import_messages(conversation: str = CONVERSATION_ID) -> List[AnyComponent]:
+    return [
+        c.Page(
+            components=[
+                c.Heading(text="Import Messages", level=2),
+                c.Paragraph(text="Messages from a JSON, JSONL or CSV archive are appended to the conversation."),
+                c.Form(
+                    form_fields=[
+                        c.FileInput(name="file", label="Archive", accept=".json,.jsonl,.ndjson,.csv"),
+                    ],
+                    submit_url=url('/api/import', conversation),
+                    submit_button_text="📥 Import",
+                ),
+                c.Button(text="↩️ Back to Conversation", on_click=navigate(url('/', conversation))),
+            ]
+        )
+    ]
+
+class CatalogEntry(BaseModel):
+    id: str
+    title: str
+    count: int
+    updated: str
+
+@ui.page('/conversations')
+def conversation_catalog(after: str = '') -> List[AnyComponent]:
+    # Titles and counts come from the storage's catalog, one page at a time;
+    # no conversation is loaded until it is opened.
+    entries, more = storage.list_conversations(CATALOG_PAGE_SIZE, after=decode_cursor(after, CATALOG_KEY_TYPES))
+    rows = [
+        CatalogEntry(
+            id=entry["id"], title=entry["title"], count=entry["count"],
+            updated=time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["updated"])),
+        )
+        for entry in entries
+    ]
+    navigation = []
+    if after:
+        navigation.append(c.Link(components=[c.Text(text="First page")], on_click=GoToEvent(url='/conversations')))
+    if more:
+        cursor = encode_cursor(conversation_storage.catalog_cursor(entries[-1]))
+        navigation.append(c.Link(
+            components=[c.Text(text="Next →")],
+            on_click=GoToEvent(url='/conversations?' + urlencode({'after': cursor})),
+        ))
+    return [
+        c.Page(
+            components=[
+                c.Heading(text="Conversations", level=1),
+                c.Table(
+                    data=rows,
+                    data_model=CatalogEntry,
+                    columns=[
+                        DisplayLookup(field='title', header='Title'),
+                        DisplayLookup(field='count', header='Messages'),
+                        DisplayLookup(field='updated', header='Updated'),
+                    ],
+                    actions=[
+                        c.Button(text="📂 Open", on_click=navigate('/?conversation={item.id}')),
+                    ],
+                ) if rows else c.Paragraph(text="No conversations yet."),
+                c.Div(components=navigation),
+                c.Form(
+                    form_fields=[
+                        c.TextInput(name="conversation", label="New conversation id"),
+                        c.TextInput(name="title", label="Title"),
+                    ],
+                    submit_url="/api/conversations",
+                    submit_button_text="➕ New Conversation",
                 ),
                 c.Button(text="↩️ Back to Conversation", on_click=navigate('/')),
             ]
@@ -119,37 +619,333 @@ def export_csv() -> List[AnyComponent]:
     ]
 
 @app.post("/api/edit/{id}")
-def edit_message_api(id: int, form: FastUIForm):
-    message = next((m for m in state.messages if m.id == id), None)
+def edit_message_api(id: int, form: FastUIForm, conversation: str = CONVERSATION_ID):
+    state = conversations.get(conversation)
+    state.refresh()
+    message = state.messages.get(id)
     if message:
-        message.sender = form.data.get("sender", message.sender)
-        message.content = form.data.get("content", message.content)
-    return GoToEvent(url='/')
+        try:
+            state.edit_message(
+                id,
+                sender=form.data.get("sender", message.sender),
+                content=form.data.get("content", message.content),
+            )
+        except conversation_storage.ConflictError:
+            raise conflict()
+    return GoToEvent(url=url('/', conversation))
 
 @app.post("/api/add")
-def add_message_api(form: FastUIForm):
-    new_id = max(m.id for m in state.messages) + 1
-    new_message = Message(
-        id=new_id,
-        sender=form.data.get("sender", ""),
-        content=form.data.get("content", "")
-    )
-    state.messages.append(new_message)
-    return GoToEvent(url='/')
+def add_message_api(form: FastUIForm, conversation: str = CONVERSATION_ID):
+    state = conversations.get(conversation)
+    state.refresh()
+    try:
+        state.add_message(
+            sender=form.data.get("sender", ""),
+            content=form.data.get("content", "")
+        )
+    except conversation_storage.ConflictError:
+        raise conflict()
+    return GoToEvent(url=url('/', conversation))
 
 @app.post("/api/delete")
-def delete_message_api(id: int):
-    state.messages = [m for m in state.messages if m.id != id]
-    return GoToEvent(url='/')
+def delete_message_api(id: int, conversation: str = CONVERSATION_ID):
+    state = conversations.get(conversation)
+    state.refresh()
+    try:
+        state.delete_message(id)
+    except conversation_storage.ConflictError:
+        raise conflict()
+    return GoToEvent(url=url('/', conversation))
+
+class BatchSelection(BaseModel):
+    ids: List[int]
+
+class BatchSender(BatchSelection):
+    sender: str
+
+class BatchReplace(BatchSelection):
+    find: str
+    replace: str = ''
+
+def apply_batch(state: ConversationState, action: str, ids: List[int], sender: str = '', find: str = '',
+                replace: str = '') -> int:
+    # Every change in the batch is committed together, so a conflict on any
+    # selected message rejects the whole batch
+    if action == 'sender' and not sender:
+        raise HTTPException(status_code=400, detail="Enter the new sender.")
+    if action == 'replace' and not find:
+        raise HTTPException(status_code=400, detail="Enter the text to replace.")
+    state.refresh()
+    try:
+        if action == 'delete':
+            return state.delete_messages(ids)
+        if action == 'sender':
+            return state.edit_messages(ids, lambda m: {"sender": sender} if m.sender != sender else {})
+        if action == 'replace':
+            def edit(message: Message) -> dict:
+                content = message.content.replace(find, replace)
+                return {"content": content} if content != message.content else {}
+            return state.edit_messages(ids, edit)
+    except conversation_storage.ConflictError:
+        raise conflict()
+    raise HTTPException(status_code=400, detail=f"Unknown batch action: {action}")
+
+@app.post("/api/batch/delete")
+def batch_delete_api(batch: BatchSelection, conversation: str = CONVERSATION_ID):
+    return {"changed": apply_batch(conversations.get(conversation), 'delete', batch.ids)}
+
+@app.post("/api/batch/sender")
+def batch_sender_api(batch: BatchSender, conversation: str = CONVERSATION_ID):
+    return {"changed": apply_batch(conversations.get(conversation), 'sender', batch.ids, sender=batch.sender)}
+
+@app.post("/api/batch/replace")
+def batch_replace_api(batch: BatchReplace, conversation: str = CONVERSATION_ID):
+    state = conversations.get(conversation)
+    return {"changed": apply_batch(state, 'replace', batch.ids, find=batch.find, replace=batch.replace)}
+
+@app.post("/api/batch")
+async def batch_form_api(request: Request, conversation: str = CONVERSATION_ID):
+    # The multi-select form on /
+    state = await run_in_threadpool(conversations.get, conversation)
+    form = await request.form()
+    try:
+        ids = [int(id) for id in form.getlist("ids")]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid message id")
+    await run_in_threadpool(
+        apply_batch, state, form.get("action", "delete"), ids,
+        sender=form.get("sender", ""), find=form.get("find", ""), replace=form.get("replace", ""),
+    )
+    return GoToEvent(url=url('/', conversation))
+
+@app.post("/api/import")
+async def import_messages_api(request: Request, conversation: str = CONVERSATION_ID):
+    # Starlette spools the upload to a temporary file; it is parsed and
+    # written in batches on a worker thread.
+    state = await run_in_threadpool(conversations.get, conversation)
+    form = await request.form()
+    upload = form.get("file")
+    if upload is None or not getattr(upload, "filename", None):
+        raise HTTPException(status_code=400, detail="Choose a file to import.")
+    try:
+        await run_in_threadpool(
+            history_import.import_history, state.storage, state.conversation_id, upload.file,
+            history_import.detect_format(upload.filename),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Import failed: {e}")
+    finally:
+        await upload.close()
+        await run_in_threadpool(state.refresh)
+    return GoToEvent(url=url('/', conversation))
 
-def generate_csv():
+@app.post("/api/conversations")
+def create_conversation_api(form: FastUIForm):
+    conversation = form.data.get("conversation", "").strip()
+    try:
+        conversation_storage.check_conversation_id(conversation)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not storage.exists(conversation):
+        storage.save_history(conversation, [])
+    title = form.data.get("title", "").strip()
+    if title:
+        storage.set_title(conversation, title)
+    return GoToEvent(url=url('/', conversation))
+
+class FeedWatcher:
+    # One poll of the feed per process, however many streams are open: a
+    # background task reads the feed position on a worker thread every
+    # FEED_POLL_SECONDS and wakes the streams waiting for it to move.
+    def __init__(self, feed, interval: float):
+        self.feed = feed
+        self.interval = interval
+        self.position = None
+        self._moved = None
+        self._task = None
+
+    async def wait(self, position: int, timeout: float) -> Optional[int]:
+        # The feed position once it is past `position`, or whatever it is
+        # after `timeout`. A stream can be ahead of the last poll (it read the
+        # feed itself); it waits for the poll to catch up rather than spin.
+        if self._task is None or self._task.done():
+            self._moved = asyncio.Event()
+            self._task = asyncio.create_task(self._poll())
+        while self.position is None or self.position <= position:
+            moved = self._moved
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(moved.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+            timeout -= time.monotonic() - started
+        return self.position
+
+    async def _poll(self):
+        while True:
+            position = await run_in_threadpool(self.feed.position)
+            if position != self.position:
+                self.position = position
+                moved, self._moved = self._moved, asyncio.Event()
+                moved.set()
+            await asyncio.sleep(self.interval)
+
+watcher = FeedWatcher(feed, FEED_POLL_SECONDS)
+
+async def follow_changes(request: Request, conversation: str, since: int) -> AsyncIterator[tuple]:
+    # Yields (seq, ops) for each change after `since`, with ops None when the
+    # client has to reload, and (None, None) when a keepalive is due. The feed
+    # itself is only read, on a worker thread, once the watcher has seen it
+    # move, so idle streams cost nothing but a wakeup.
+    position = since
+    last_sent = time.monotonic()
+    while not await request.is_disconnected():
+        current = await watcher.wait(position, FEED_KEEPALIVE_SECONDS)
+        changes = []
+        if current is not None and current != position:
+            position, changes = await run_in_threadpool(feed.since, conversation, position)
+            if changes is None:
+                last_sent = time.monotonic()
+                yield position, None
+                continue
+        for seq, ops in changes:
+            yield seq, ops
+        if changes:
+            last_sent = time.monotonic()
+        elif time.monotonic() - last_sent >= FEED_KEEPALIVE_SECONDS:
+            last_sent = time.monotonic()
+            yield None, None
+
+async def stream_position(request: Request, since: Optional[int]) -> int:
+    # A reconnecting EventSource sends the last id it saw as Last-Event-ID
+    last_event_id = request.headers.get("last-event-id", "")
+    if last_event_id.isdigit():
+        return int(last_event_id)
+    return since if since is not None else await run_in_threadpool(feed.position)
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+@app.get("/api/changes")
+async def change_stream(request: Request, conversation: str = CONVERSATION_ID, since: Optional[int] = None):
+    # Server-sent events: "change" carries the ops of one commit, with the
+    # feed sequence number as its id; "reset" means refetch the conversation.
+    async def events() -> AsyncIterator[str]:
+        async for seq, ops in follow_changes(request, conversation, await stream_position(request, since)):
+            if seq is None:
+                yield ": keepalive\n\n"
+            elif ops is None:
+                yield change_feed.sse_event("reset", {}, seq)
+            else:
+                yield change_feed.sse_event("change", ops, seq)
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+def describe_op(op: dict) -> str:
+    if op["op"] == "add":
+        return f"Message {op['message']['id']} added by {op['message']['sender']}"
+    if op["op"] == "edit":
+        return f"Message {op['id']} edited"
+    return f"Message {op['id']} deleted"
+
+@app.get("/api/changes/live")
+async def live_changes(request: Request, conversation: str = CONVERSATION_ID):
+    # The live panel on /: FastUI replaces the panel with each event's
+    # components. The recent changes are kept per connection, so every event
+    # only costs the new changes.
+    recent = deque(maxlen=LIVE_CHANGES_SHOWN)
+
+    def panel(count: int) -> str:
+        components = [
+            c.Paragraph(text=f"🔴 {count} changes since this page loaded"),
+            *(c.Text(text=line) for line in reversed(recent)),
+            c.Link(components=[c.Text(text="↻ Refresh")], on_click=GoToEvent(url=url('/', conversation))),
+        ] if count else []
+        return "data: " + json.dumps([
+            component.model_dump(by_alias=True, exclude_none=True, mode='json') for component in components
+        ]) + "\n\n"
+
+    async def events() -> AsyncIterator[str]:
+        count = 0
+        yield panel(count)
+        async for seq, ops in follow_changes(request, conversation, await stream_position(request, None)):
+            if seq is None:
+                yield ": keepalive\n\n"
+                continue
+            for op in ops if ops is not None else [{"op": "reset"}]:
+                recent.append("Conversation replaced" if op["op"] == "reset" else describe_op(op))
+                count += 1
+            yield panel(count)
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.get("/api/export.csv")
+def export_csv_download(request: Request, conversation: str = CONVERSATION_ID, compress: bool = True):
+    headers = {
+        "Content-Disposition": 'attachment; filename="conversation_history.csv"',
+        "Vary": "Accept-Encoding",
+    }
+    state = conversations.get(conversation)
+    state.refresh()
+    gzipped = compress and "gzip" in request.headers.get("accept-encoding", "")
+    # The gzip and identity bodies differ, so they get different tags
+    etag = state.etag()[:-1] + ('.gz"' if gzipped else '"')
+    if not_modified(request, etag):
+        raise HTTPException(status_code=304, headers={"ETag": etag, **headers})
+    headers["ETag"] = etag
+    headers["Cache-Control"] = "no-cache"
+    chunks = generate_csv(state)
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+        chunks = gzip_chunks(chunks)
+    return StreamingResponse(chunks, media_type="text/csv", headers=headers)
+
+def generate_csv(state: ConversationState) -> Iterator[bytes]:
+    # Timed by hand: the response is streamed from worker threads, so the
+    # generator can't hold a metrics.timed context open across yields.
+    start = time.perf_counter()
+    written = 0
     output = StringIO()
     writer = csv.writer(output)
     writer.writerow(['id', 'sender', 'content'])
-    for message in state.messages:
-        writer.writerow([message.id, message.sender, message.content])
-    return output.getvalue()
+    try:
+        # Take references up front so concurrent edits can't break iteration;
+        # rows are still serialised one chunk at a time.
+        for message in list(state.messages):
+            writer.writerow([message.id, message.sender, message.content])
+            if output.tell() >= CSV_CHUNK_SIZE:
+                chunk = output.getvalue().encode('utf-8')
+                written += len(chunk)
+                yield chunk
+                output.seek(0)
+                output.truncate()
+        chunk = output.getvalue().encode('utf-8')
+        written += len(chunk)
+        yield chunk
+    finally:
+        metrics.observe("generate_csv", time.perf_counter() - start, written=written)
+        metrics.record_bytes(written=written, operation="generate_csv")
+
+def gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
 
 if __name__ == "__main__":
+    import argparse
+    import os
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    parser = argparse.ArgumentParser(description="Serve the FastUI conversation history.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 1)))
+    args = parser.parse_args()
+    # Extra workers import the app by module name and each builds its own
+    # ConversationState over the shared storage; use CONVERSATION_STORAGE=sqlite:...
+    # so they follow each other through the change log rather than reloading.
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    uvicorn.run(
+        app if args.workers == 1 else f"{module}:app",
+        host=args.host, port=args.port, workers=args.workers,
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+    )
@@ -0,0 +1,75 @@
+import csv
+import io
+import json
+import os
+import tempfile
+
+import metrics
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Export of conversation histories in record batches.
+#
+# Writers consume an iterable of message batches and stream them straight into
+# a temporary file, so no DataFrame or whole-file buffer is ever built.
+
+EXPORT_BATCH_SIZE = 10_000  # Messages per record batch
+FIELDS = ["id", "sender", "content"]
+
+
+def batched(history, batch_size=EXPORT_BATCH_SIZE):
+    for start in range(0, len(history), batch_size):
+        yield history[start:start + batch_size]
+
+
+def write_csv(batches, f):
+    text = io.TextIOWrapper(f, encoding="utf-8", newline="", write_through=True)
+    writer = csv.DictWriter(text, fieldnames=FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for batch in batches:
+        writer.writerows(batch)
+    text.detach()
+
+
+def write_jsonl(batches, f):
+    for batch in batches:
+        f.write("".join(
+            json.dumps({field: message[field] for field in FIELDS}) + "\n" for message in batch
+        ).encode("utf-8"))
+
+
+def write_parquet(batches, f):
+    schema = pa.schema([("id", pa.int64()), ("sender", pa.string()), ("content", pa.string())])
+    with pq.ParquetWriter(f, schema) as writer:
+        for batch in batches:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+
+
+EXPORT_FORMATS = {
+    "CSV": (write_csv, "csv", "text/csv"),
+    "JSONL": (write_jsonl, "jsonl", "application/x-ndjson"),
+    "Parquet": (write_parquet, "parquet", "application/vnd.apache.parquet"),
+}
+
+
+def available_formats():
+    return [name for name in EXPORT_FORMATS if name != "Parquet" or pa is not None]
+
+
+@metrics.timed("export")
+def export_history(batches, export_format):
+    # Returns (file, file name, mime type); the caller closes the file.
+    writer, extension, mime = EXPORT_FORMATS[export_format]
+    with tempfile.NamedTemporaryFile(suffix=f".{extension}", delete=False) as f:
+        writer(batches, f)
+        metrics.record_bytes(written=f.tell())
+    data = open(f.name, "rb")
+    try:
+        os.remove(f.name)  # The open handle keeps the data readable
+    except OSError:
+        pass
+    return data, f"conversation_history.{extension}", mime
@@ -0,0 +1,224 @@
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import sys
+
+import conversation_storage
+import metrics
+
+# Streaming import of conversation archives.
+#
+# Readers turn a binary file into an iterator of messages without holding the
+# file in memory:
+#
+#   JSON   a list of messages (the apps' original conversation_history.json),
+#          or a saved application {"appName": ..., "conversation": [...]}
+#   JSONL  one message per line (the JSONL export)
+#   CSV    id,sender,content rows (the CSV exports)
+#
+# JSON is decoded an element at a time from a sliding buffer, so only the
+# message being parsed is ever in memory in full. Imported messages are
+# appended to the conversation with fresh ids, allocated as one block, and
+# written IMPORT_BATCH_SIZE at a time with the storage's bulk append, which
+# leaves compaction until the last batch.
+#
+#   python history_import.py archive.jsonl
+#   python history_import.py my_app_application.json --storage sqlite:conversations.db --conversation archive
+
+IMPORT_BATCH_SIZE = 5_000  # Messages per commit
+READ_CHUNK_SIZE = 1 << 20  # Characters read into the JSON buffer at a time
+MAX_RECORD_SIZE = 64 << 20  # Characters one JSON message may span
+DEFAULT_STORAGE = "file:conversation_history.json"
+EXTENSIONS = {".json": "JSON", ".jsonl": "JSONL", ".ndjson": "JSONL", ".csv": "CSV"}
+
+csv.field_size_limit(min(sys.maxsize, 2**31 - 1))  # Message content may be long
+
+
+class _JSONStream:
+    def __init__(self, text):
+        self._text = text
+        self._buffer = ""
+        self._pos = 0
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        data = self._text.read(READ_CHUNK_SIZE)
+        if not data:
+            return False
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def peek(self):
+        # Next non-whitespace character, or "" at the end of the file
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in " \t\r\n":
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Expected one of {chars!r} in JSON, found {char or 'end of file'!r}")
+        self._pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if len(self._buffer) - self._pos > MAX_RECORD_SIZE or not self._fill():
+                    raise
+                continue
+            # A number can end at the buffer's edge and still continue after it
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+
+@contextlib.contextmanager
+def _text(f, **kwargs):
+    # Text view of the binary file that leaves the file open afterwards
+    text = io.TextIOWrapper(f, encoding="utf-8-sig", **kwargs)
+    try:
+        yield text
+    finally:
+        text.detach()
+
+
+def read_json(f):
+    with _text(f) as text:
+        yield from _read_json(_JSONStream(text))
+
+
+def _read_json(stream):
+    if stream.peek() == "{":
+        # Saved application: skip to its "conversation" array
+        stream.expect("{")
+        while True:
+            if stream.peek() == "}":
+                raise ValueError("No conversation found in this JSON file")
+            key = stream.value()
+            stream.expect(":")
+            if key == "conversation":
+                break
+            stream.value()
+            if stream.expect(",}") == "}":
+                raise ValueError("No conversation found in this JSON file")
+    stream.expect("[")
+    if stream.peek() == "]":
+        return
+    while True:
+        yield stream.value()
+        if stream.expect(",]") == "]":
+            return
+
+
+def read_jsonl(f):
+    with _text(f) as text:
+        for line in text:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_csv(f):
+    with _text(f, newline="") as text:
+        yield from csv.DictReader(text)
+
+
+IMPORT_FORMATS = {
+    "JSON": read_json,
+    "JSONL": read_jsonl,
+    "CSV": read_csv,
+}
+
+
+def detect_format(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in EXTENSIONS:
+        raise ValueError(f"Can't tell the format of {filename!r}; expected one of {', '.join(EXTENSIONS)}")
+    return EXTENSIONS[extension]
+
+
+def _messages(records):
+    for number, record in enumerate(records, start=1):
+        if not isinstance(record, dict):
+            raise ValueError(f"Record {number} is not a message")
+        yield {"sender": str(record.get("sender") or ""), "content": str(record.get("content") or "")}
+
+
+def _batches(messages, batch_size):
+    # (batch, is_last) pairs
+    batch = []
+    for message in messages:
+        if len(batch) >= batch_size:
+            yield batch, False
+            batch = []
+        batch.append(message)
+    if batch:
+        yield batch, True
+
+
+def _next_id(storage, conversation_id):
+    pages = storage.open_pages(conversation_id)
+    return pages.next_id if pages is not None else 1
+
+
+@metrics.timed("import")
+def import_history(storage, conversation_id, f, import_format, progress=None, batch_size=IMPORT_BATCH_SIZE):
+    # Appends every message in binary file `f` to the conversation and
+    # returns how many were imported. progress(count) is called after each
+    # batch. Ids continue from the conversation's; if another writer takes
+    # some of them first, the batch is renumbered and retried.
+    next_id = _next_id(storage, conversation_id)
+    count = 0
+    for batch, last in _batches(_messages(IMPORT_FORMATS[import_format](f)), batch_size):
+        while True:
+            messages = [{"id": message_id, **message} for message_id, message in enumerate(batch, start=next_id)]
+            try:
+                storage.append_messages(conversation_id, messages, compact=last)
+            except conversation_storage.ConflictError:
+                next_id = _next_id(storage, conversation_id)
+                continue
+            break
+        next_id += len(batch)
+        count += len(batch)
+        if progress is not None:
+            progress(count)
+    try:
+        metrics.record_bytes(read=f.tell())
+    except (OSError, ValueError):
+        pass
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import a conversation archive (JSON, JSONL or CSV).")
+    parser.add_argument("file")
+    parser.add_argument("--format", choices=list(IMPORT_FORMATS), help="Default: from the file extension")
+    parser.add_argument("--storage", default=DEFAULT_STORAGE, help=f"Storage URL (default {DEFAULT_STORAGE})")
+    parser.add_argument("--conversation", default=conversation_storage.DEFAULT_CONVERSATION)
+    args = parser.parse_args(argv)
+
+    storage = conversation_storage.open_storage(args.storage)
+    import_format = args.format or detect_format(args.file)
+    with open(args.file, "rb") as f:
+        count = import_history(
+            storage, args.conversation, f, import_format,
+            progress=lambda count: print(f"Imported {count:,} messages", file=sys.stderr),
+        )
+    print(f"Imported {count:,} messages into {args.conversation}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+import heapq
+import itertools
+import math
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from typing import NamedTuple
+
+import conversation_storage
+
+# Incremental full-text search over message content and sender.
+#
+# Each conversation gets an in-memory inverted index (token -> {message id:
+# term count}) built once from storage in batches and then kept current from
+# the ops committed through conversation_storage. Queries match every term,
+# starting from the rarest posting list, and rank hits with BM25. When even the
+# rarest term is very common, only its most recent matches are scored, which
+# keeps query time bounded regardless of history size. Only the
+# INDEX_CACHE_SIZE most recently searched conversations keep their index.
+
+SEARCH_BATCH_SIZE = 10_000  # Messages loaded per batch when building an index
+SNIPPET_RADIUS = 60  # Characters of context on each side of the first hit
+SEARCH_MAX_CANDIDATES = 20_000  # Most recent matches scored for very common terms
+INDEX_BUILD_ATTEMPTS = 3  # Builds tried before an index is served uncached
+INDEX_CACHE_SIZE = 16  # Conversations whose indexes are kept in memory
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN = re.compile(r"\w+")
+_indexes = OrderedDict()  # (storage, conversation id) -> SearchIndex, least recently used first
+_indexes_lock = threading.Lock()
+
+
+class SearchResult(NamedTuple):
+    message_id: int
+    sender: str
+    score: float
+    snippet: str
+
+
+def tokenize(text):
+    return _TOKEN.findall(text.lower())
+
+
+def snippet(content, terms):
+    hits = [re.search(rf"\b{re.escape(term)}\b", content, re.IGNORECASE) for term in terms]
+    hits = [(hit.start(), hit.group()) for hit in hits if hit]
+    if not hits:
+        return content[:2 * SNIPPET_RADIUS]
+    position, term = min(hits)
+    start = max(0, position - SNIPPET_RADIUS)
+    end = min(len(content), position + len(term) + SNIPPET_RADIUS)
+    text = (
+        content[start:position]
+        + "**" + content[position:position + len(term)] + "**"
+        + content[position + len(term):end]
+    )
+    return ("…" if start > 0 else "") + " ".join(text.split()) + ("…" if end < len(content) else "")
+
+
+class SearchIndex:
+    def __init__(self):
+        self._postings = defaultdict(dict)
+        self._docs = {}  # message id -> message dict
+        self._lengths = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+        self.version = None
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _tokens(self, message):
+        return tokenize(message["sender"]) + tokenize(message["content"])
+
+    def _add(self, message):
+        tokens = self._tokens(message)
+        counts = defaultdict(int)
+        for token in tokens:
+            counts[token] += 1
+        for token, count in counts.items():
+            self._postings[token][message["id"]] = count
+        self._docs[message["id"]] = message
+        self._lengths[message["id"]] = len(tokens)
+        self._total_length += len(tokens)
+
+    def _remove(self, message_id):
+        message = self._docs.pop(message_id, None)
+        if message is None:
+            return None
+        for token in set(self._tokens(message)):
+            postings = self._postings[token]
+            postings.pop(message_id, None)
+            if not postings:
+                del self._postings[token]
+        self._total_length -= self._lengths.pop(message_id)
+        return message
+
+    def add(self, message):
+        with self._lock:
+            self._remove(message["id"])
+            self._add(message)
+
+    def remove(self, message_id):
+        with self._lock:
+            self._remove(message_id)
+
+    def apply(self, ops):
+        with self._lock:
+            for op in ops:
+                kind = op["op"]
+                if kind == "add":
+                    self._remove(op["message"]["id"])
+                    self._add(op["message"])
+                elif kind == "edit":
+                    message = self._remove(op["id"])
+                    if message is not None:
+                        self._add({**message, **op["fields"]})
+                elif kind == "delete":
+                    self._remove(op["id"])
+
+    def search(self, query, limit=10):
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            postings = [self._postings.get(term) for term in terms]
+            if not all(postings):
+                return []
+            postings.sort(key=len)
+            candidates = itertools.islice(reversed(postings[0]), SEARCH_MAX_CANDIDATES)
+            for other in postings[1:]:
+                candidates = [i for i in candidates if i in other]
+            n = len(self._docs)
+            average_length = self._total_length / n
+            idf = [math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for p in postings]
+
+            def score(message_id):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[message_id] / average_length)
+                return sum(
+                    weight * p[message_id] * (BM25_K1 + 1) / (p[message_id] + norm)
+                    for weight, p in zip(idf, postings)
+                )
+
+            ranked = heapq.nlargest(limit, ((score(i), i) for i in candidates))
+            return [
+                SearchResult(i, self._docs[i]["sender"], s, snippet(self._docs[i]["content"], terms))
+                for s, i in ranked
+            ]
+
+
+def _build(storage, conversation_id):
+    index = SearchIndex()
+    index.version = storage.version(conversation_id)
+    pages = storage.open_pages(conversation_id)
+    if pages is not None:
+        for batch in pages.batches(SEARCH_BATCH_SIZE):
+            for message in batch:
+                index.add(message)
+    return index
+
+
+def index_for(storage, conversation_id):
+    # Rebuilt only when the conversation was changed without going through
+    # this process (another worker, or a wholesale save_history).
+    # The build runs outside the lock so commits elsewhere aren't held up by
+    # it; if the conversation changed meanwhile, the build is done again.
+    key = (id(storage), conversation_id)
+    for _ in range(INDEX_BUILD_ATTEMPTS):
+        with _indexes_lock:
+            index = _indexes.get(key)
+            if index is not None and index.version == storage.version(conversation_id):
+                _indexes.move_to_end(key)
+                return index
+        index = _build(storage, conversation_id)
+        with _indexes_lock:
+            if index.version == storage.version(conversation_id):
+                _indexes[key] = index
+                _indexes.move_to_end(key)
+                while len(_indexes) > INDEX_CACHE_SIZE:
+                    _indexes.popitem(last=False)
+                return index
+    return index  # Still changing: serve this build without caching it
+
+
+def _on_commit(storage, conversation_id, ops):
+    key = (id(storage), conversation_id)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            return
+        if ops is None:
+            del _indexes[key]
+            return
+        index.apply(ops)
+        index.version = storage.version(conversation_id)
+
+
+conversation_storage.subscribe(_on_commit)
@@ -0,0 +1,818 @@
+import contextlib
+import json
+import lzma
+import os
+import struct
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are only serialised within one process
+    fcntl = None
+
+# Append-only persistence for conversation histories.
+#
+# The history at `path` is a JSON snapshot (the same list of messages the apps
+# have always written) plus a `<path>.journal` file of JSONL operation records.
+# Single edits append one small record; the journal is folded back into the
+# snapshot by a background compaction once it grows relative to the snapshot.
+#
+# Snapshots are written one message per line, and a `<path>.idx` sidecar maps
+# each message ordinal to its id and byte offset so a page can be read without
+# parsing the whole file.
+#
+# Snapshots are normally stored compressed: messages are grouped into blocks of
+# SEGMENT_MESSAGES lines, each compressed on its own (zlib with a dictionary
+# sampled from the history, or lzma), and the index points at the block. Page
+# reads decompress only the blocks they touch. HISTORY_COMPRESSION=none keeps
+# the plain JSON layout, and either layout is read back.
+#
+# The index also records the snapshot's generation: the number of journal
+# bytes ever committed to the history (plus one per wholesale save). A
+# compaction moves the journal's bytes into it, so the snapshot's generation
+# plus the journal's size only changes when the content does.
+#
+# Writers from every session and process serialise on a `<path>.lock` file
+# lock, and within a process on a lock per path, so one conversation never
+# waits on another. Each message carries a `version` that edits bump, so a
+# writer can pass the version it last saw and get a ConflictError instead of
+# silently overwriting someone else's change. Commits arriving within
+# GROUP_COMMIT_WINDOW are written together with a single fsync.
+
+JOURNAL_SUFFIX = ".journal"
+INDEX_SUFFIX = ".idx"
+LOCK_SUFFIX = ".lock"
+INDEX_MAGIC = b"CHIX"
+INDEX_HEADER = struct.Struct("<4sIQQ")  # magic, flags, message count, snapshot size
+INDEX_ENTRY = struct.Struct("<qQ")  # message id, byte offset in the snapshot
+INDEX_SORTED = 1  # Ids increase with ordinal, so ids can be binary searched
+INDEX_SEGMENTED = 2  # Offsets point at compressed blocks rather than lines
+INDEX_GENERATION = 4  # The header is followed by the snapshot's generation
+INDEX_GENERATION_FIELD = struct.Struct("<Q")
+SEGMENT_MAGIC = b"CHSG"
+SEGMENT_HEADER = struct.Struct("<4sBII")  # magic, codec, messages per block, dictionary size
+SEGMENT_LENGTH = struct.Struct("<I")  # compressed size of the block that follows
+SEGMENT_MESSAGES = 128  # Messages per compressed block
+SEGMENT_DICTIONARY_BYTES = 32 * 1024  # zlib's maximum dictionary size
+SNAPSHOT_CODEC = os.environ.get("HISTORY_COMPRESSION", "zlib")  # "zlib", "lzma" or "none"
+CODECS = {"zlib": 1, "lzma": 2}
+COMPACT_MIN_BYTES = 64 * 1024  # Never compact journals smaller than this
+COMPACT_RATIO = 0.5  # Compact once the journal reaches this fraction of the snapshot
+GROUP_COMMIT_WINDOW = 0.005  # Seconds a commit waits for others to share its fsync
+TRACKER_CACHE_SIZE = 64  # Files whose message versions are kept in memory between commits
+
+_lock = threading.RLock()  # Guards the tables below; only held briefly
+_path_locks = weakref.WeakValueDictionary()  # path -> RLock serialising this process's use of the file
+_compacting = set()
+_pending = {}  # path -> commits waiting for the group leader
+_trackers = OrderedDict()  # path -> _VersionTracker, least recently used first
+
+
+class ConflictError(Exception):
+    def __init__(self, message_ids):
+        super().__init__(f"Messages changed by another writer: {sorted(message_ids)}")
+        self.message_ids = message_ids
+
+
+def journal_path(path):
+    return path + JOURNAL_SUFFIX
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def add_op(message):
+    return {"op": "add", "message": message}
+
+
+def edit_op(message_id, base_version=None, **fields):
+    op = {"op": "edit", "id": message_id, "fields": fields}
+    if base_version is not None:
+        op["base"] = base_version
+    return op
+
+
+def delete_op(message_id, base_version=None):
+    op = {"op": "delete", "id": message_id}
+    if base_version is not None:
+        op["base"] = base_version
+    return op
+
+
+def message_version(message):
+    return message.get("version", 1)
+
+
+def replay(history, ops):
+    # Ops are idempotent, so replaying a journal that was already folded into
+    # the snapshot (e.g. after a crash mid-compaction) is harmless.
+    messages = {m["id"]: m for m in history}
+    for op in ops:
+        kind = op["op"]
+        if kind == "add":
+            messages[op["message"]["id"]] = op["message"]
+        elif kind == "edit":
+            message = messages.get(op["id"])
+            if message is not None:
+                messages[op["id"]] = {**message, **op["fields"]}
+                if "version" in op:
+                    messages[op["id"]]["version"] = op["version"]
+        elif kind == "delete":
+            messages.pop(op["id"], None)
+    return list(messages.values())
+
+
+class _PlainReader:
+    # One JSON message per line, at the byte offset the index gives.
+
+    def __init__(self, f):
+        self._f = f
+
+    def record(self, ordinal, offset):
+        self._f.seek(offset)
+        line = self._f.readline()
+        metrics.record_bytes(read=len(line))
+        return line.rstrip(b",\n")
+
+
+class _SegmentReader:
+    # Compressed blocks of `block_messages` lines; the last block read is kept
+    # decompressed, since page reads are sequential.
+
+    def __init__(self, f):
+        self._f = f
+        magic, self.codec, self.block_messages, dictionary_size = SEGMENT_HEADER.unpack(
+            f.read(SEGMENT_HEADER.size)
+        )
+        if magic != SEGMENT_MAGIC:
+            raise ValueError("Not a segmented history")
+        self._dictionary = f.read(dictionary_size)
+        self.data_offset = SEGMENT_HEADER.size + dictionary_size
+        self._block_offset = None
+        self._lines = []
+
+    def _decompress(self, data):
+        if self.codec == CODECS["zlib"]:
+            decompressor = zlib.decompressobj(zdict=self._dictionary) if self._dictionary else zlib.decompressobj()
+            return decompressor.decompress(data) + decompressor.flush()
+        return lzma.decompress(data)
+
+    def block(self, offset):
+        # (decompressed lines, offset of the next block)
+        self._f.seek(offset)
+        (size,) = SEGMENT_LENGTH.unpack(self._f.read(SEGMENT_LENGTH.size))
+        metrics.record_bytes(read=SEGMENT_LENGTH.size + size)
+        lines = self._decompress(self._f.read(size)).splitlines()
+        return lines, offset + SEGMENT_LENGTH.size + size
+
+    def record(self, ordinal, offset):
+        if offset != self._block_offset:
+            self._lines, _ = self.block(offset)
+            self._block_offset = offset
+        return self._lines[ordinal % self.block_messages]
+
+    def records(self, end):
+        offset = self.data_offset
+        while offset < end:
+            lines, offset = self.block(offset)
+            yield from lines
+
+
+def _read_snapshot(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as f:
+        if f.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+            f.seek(0)
+            metrics.record_bytes(read=os.fstat(f.fileno()).st_size)
+            return json.load(f)
+        f.seek(0)
+        reader = _SegmentReader(f)
+        return [json.loads(line) for line in reader.records(os.fstat(f.fileno()).st_size)]
+
+
+def _read_journal(path):
+    ops = []
+    jpath = journal_path(path)
+    if os.path.exists(jpath):
+        with open(jpath, "r") as f:
+            metrics.record_bytes(read=os.fstat(f.fileno()).st_size)
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    ops.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue  # Torn write from a writer that crashed mid-append
+    return ops
+
+
+def _path_lock(path):
+    with _lock:
+        lock = _path_locks.get(path)
+        if lock is None:
+            lock = _path_locks[path] = threading.RLock()
+        return lock
+
+
+@contextlib.contextmanager
+def _file_lock(path, shared=False):
+    # Callers hold _path_lock(path) first; flock is not re-entrant across
+    # file handles, so this must never be nested.
+    if fcntl is None:
+        yield
+        return
+    with open(path + LOCK_SUFFIX, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def exists(path):
+    return os.path.exists(path) or os.path.exists(journal_path(path))
+
+
+def version(path):
+    # Changes whenever the history's content does, so it can key caches of the
+    # loaded history; compaction keeps it. None when nothing is stored.
+    if not exists(path):
+        return None
+    with _path_lock(path), _file_lock(path, shared=True):
+        return _version(path)
+
+
+def _version(path):
+    # The generation, unless the snapshot isn't the one its index describes
+    # (written by something other than this module): then its file stats
+    # stand in. Callers hold the file lock.
+    try:
+        with open(index_path(path), "rb") as f:
+            indexed = _Index(f).snapshot_size == os.path.getsize(path)
+    except FileNotFoundError:
+        indexed = not os.path.exists(path)  # Only a journal so far
+    except (struct.error, ValueError):
+        indexed = False
+    if indexed:
+        return _generation(path)
+    st = os.stat(path)
+    return _generation(path), st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def load_history(path):
+    if not exists(path):
+        return None
+    with _path_lock(path), _file_lock(path, shared=True):
+        return replay(_read_snapshot(path), _read_journal(path))
+
+
+def _compressor(codec, dictionary):
+    if codec == "zlib":
+        def compress(data):
+            compressor = zlib.compressobj(zdict=dictionary) if dictionary else zlib.compressobj()
+            return compressor.compress(data) + compressor.flush()
+        return compress
+    return lzma.compress
+
+
+def _sample_dictionary(lines):
+    # Lines spread over the whole history; zlib favours the end of the
+    # dictionary, so the budget is filled from the back.
+    step = max(1, len(lines) // 256)
+    sample = b"".join(lines[::step])
+    return sample[-SEGMENT_DICTIONARY_BYTES:]
+
+
+def _write_lines(f, lines):
+    # Plain JSON array, one message per line so the index can point at
+    # individual records. Returns each line's offset and the file size.
+    offsets = []
+    f.write(b"[\n")
+    offset = 2
+    for i, line in enumerate(lines):
+        line += b",\n" if i < len(lines) - 1 else b"\n"
+        offsets.append(offset)
+        f.write(line)
+        offset += len(line)
+    f.write(b"]\n")
+    return offsets, offset + 2
+
+
+def _write_segments(f, lines, codec):
+    # Returns each line's block offset and the file size.
+    dictionary = _sample_dictionary(lines) if codec == "zlib" else b""
+    compress = _compressor(codec, dictionary)
+    f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, CODECS[codec], SEGMENT_MESSAGES, len(dictionary)))
+    f.write(dictionary)
+    offsets = []
+    offset = SEGMENT_HEADER.size + len(dictionary)
+    for start in range(0, len(lines), SEGMENT_MESSAGES):
+        block = lines[start:start + SEGMENT_MESSAGES]
+        data = compress(b"\n".join(block))
+        f.write(SEGMENT_LENGTH.pack(len(data)))
+        f.write(data)
+        offsets.extend([offset] * len(block))
+        offset += SEGMENT_LENGTH.size + len(data)
+    return offsets, offset
+
+
+def _write_snapshot(path, history, generation):
+    lines = [json.dumps(message).encode("utf-8") for message in history]
+    ids = [message["id"] for message in history]
+    ids_sorted = all(a < b for a, b in zip(ids, ids[1:]))
+    segmented = SNAPSHOT_CODEC in CODECS
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        if segmented:
+            offsets, snapshot_size = _write_segments(f, lines, SNAPSHOT_CODEC)
+        else:
+            offsets, snapshot_size = _write_lines(f, lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+    tmp_index_path = index_path(path) + ".tmp"
+    with open(tmp_index_path, "wb") as f:
+        flags = (INDEX_SORTED if ids_sorted else 0) | (INDEX_SEGMENTED if segmented else 0) | INDEX_GENERATION
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, flags, len(ids), snapshot_size))
+        f.write(INDEX_GENERATION_FIELD.pack(generation))
+        f.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in zip(ids, offsets)))
+    metrics.record_bytes(
+        written=snapshot_size + INDEX_HEADER.size + INDEX_GENERATION_FIELD.size + len(ids) * INDEX_ENTRY.size
+    )
+    os.replace(tmp_path, path)
+    os.replace(tmp_index_path, index_path(path))
+
+
+def _snapshot_generation(path):
+    # Generation recorded in the index; 0 for files from before generations
+    try:
+        with open(index_path(path), "rb") as f:
+            return _Index(f).generation
+    except (FileNotFoundError, struct.error, ValueError):
+        return 0
+
+
+def _generation(path):
+    # Counts journal bytes ever written, so it goes up with every commit but
+    # is kept by compaction, which moves the journal's bytes into the
+    # snapshot's generation. Callers hold the file lock.
+    jpath = journal_path(path)
+    return _snapshot_generation(path) + (os.path.getsize(jpath) if os.path.exists(jpath) else 0)
+
+
+def _replace_snapshot(path, history, generation):
+    _write_snapshot(path, history, generation)
+    if os.path.exists(journal_path(path)):
+        os.remove(journal_path(path))
+
+
+def save_history(path, history):
+    with _path_lock(path), _file_lock(path):
+        _replace_snapshot(path, history, _generation(path) + 1)
+        with _lock:
+            _trackers.pop(path, None)
+
+
+class _VersionTracker:
+    # Current version of every message id, kept up to date by tailing the
+    # journal so a commit doesn't have to reload the whole history.
+
+    def __init__(self, path):
+        self.path = path
+        self.versions = {}
+        self._snapshot = None  # Identity of the snapshot the versions came from
+        self._journal_offset = 0
+        self._journal_ends_cleanly = True
+
+    def _identity(self):
+        # Inode numbers are reused, so a snapshot is only taken to be the
+        # same one if its generation and full stat still match
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return _snapshot_generation(self.path), st.st_ino, st.st_mtime_ns, st.st_size
+
+    def refresh(self):
+        snapshot = self._identity()
+        jpath = journal_path(self.path)
+        journal_size = os.path.getsize(jpath) if os.path.exists(jpath) else 0
+        if snapshot != self._snapshot or journal_size < self._journal_offset:
+            self.versions = {m["id"]: message_version(m) for m in _read_snapshot(self.path)}
+            self._snapshot = snapshot
+            self._journal_offset = 0
+        if journal_size > self._journal_offset:
+            with open(jpath, "rb") as f:
+                f.seek(self._journal_offset)
+                data = f.read()
+            metrics.record_bytes(read=len(data))
+            complete = data[:data.rfind(b"\n") + 1]
+            for line in complete.splitlines():
+                try:
+                    self.apply(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+            self._journal_offset += len(complete)
+            self._journal_ends_cleanly = len(complete) == len(data)
+
+    def apply(self, op):
+        kind = op["op"]
+        if kind == "add":
+            self.versions[op["message"]["id"]] = message_version(op["message"])
+        elif kind == "edit" and op["id"] in self.versions:
+            self.versions[op["id"]] = op.get("version", self.versions[op["id"]] + 1)
+        elif kind == "delete":
+            self.versions.pop(op["id"], None)
+
+    def rebased(self):
+        # A compaction folded the journal we have read into a new snapshot
+        self._snapshot = self._identity()
+        self._journal_offset = 0
+        self._journal_ends_cleanly = True
+
+    def prepare(self, ops, pending):
+        # Check ops against current versions (and those of earlier commits in
+        # the same group, in `pending`) and stamp the versions they produce.
+        # Nothing is recorded unless every op in the commit is valid.
+        changed = {}
+        prepared = []
+        conflicts = []
+        for op in ops:
+            kind = op["op"]
+            message_id = op["message"]["id"] if kind == "add" else op["id"]
+            if message_id in changed:
+                current = changed[message_id]
+            elif message_id in pending:
+                current = pending[message_id]
+            else:
+                current = self.versions.get(message_id)
+            if kind == "add":
+                if current is not None:
+                    conflicts.append(message_id)
+                    continue
+                op = add_op({**op["message"], "version": 1})
+                changed[message_id] = 1
+            elif current is None or op.get("base", current) != current:
+                conflicts.append(message_id)
+                continue
+            elif kind == "edit":
+                op = {**op, "version": current + 1}
+                changed[message_id] = current + 1
+            else:
+                changed[message_id] = None
+            prepared.append(op)
+        if conflicts:
+            raise ConflictError(conflicts)
+        pending.update(changed)
+        return prepared
+
+    def write(self, prepared):
+        data = b"".join(_journal_record(op) for op in prepared)
+        if not self._journal_ends_cleanly:
+            data = b"\n" + data  # Terminate a torn line left by a crashed writer
+        with open(journal_path(self.path), "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        metrics.record_bytes(written=len(data))
+        for op in prepared:
+            self.apply(op)
+        self._journal_offset += len(data)
+        self._journal_ends_cleanly = True
+
+
+def _journal_record(op):
+    return (json.dumps(op) + "\n").encode("utf-8")
+
+
+class _Commit:
+    def __init__(self, ops):
+        self.ops = ops
+        self.prepared = None
+        self.error = None
+        self.versions = (None, None)  # Generation just before and after this commit's records
+        self.done = threading.Event()
+
+
+def _tracker(path):
+    # Trackers past TRACKER_CACHE_SIZE are dropped and rebuilt from the files
+    # when their conversation is next written
+    with _lock:
+        tracker = _trackers.get(path)
+        if tracker is None:
+            tracker = _trackers[path] = _VersionTracker(path)
+            while len(_trackers) > TRACKER_CACHE_SIZE:
+                _trackers.popitem(last=False)
+        else:
+            _trackers.move_to_end(path)
+        return tracker
+
+
+def _write_group(path, commits):
+    try:
+        with _path_lock(path), _file_lock(path):
+            tracker = _tracker(path)
+            tracker.refresh()
+            pending = {}
+            prepared = []
+            for commit in commits:
+                try:
+                    commit.prepared = tracker.prepare(commit.ops, pending)
+                except ConflictError as e:
+                    commit.error = e
+                    continue
+                prepared.extend(commit.prepared)
+            if prepared:
+                version = _version(path)
+                if isinstance(version, int):
+                    # Each commit's records follow the earlier commits' in
+                    # the one write (after a newline ending a torn record)
+                    version += 0 if tracker._journal_ends_cleanly else 1
+                    for commit in commits:
+                        if commit.error is None:
+                            size = sum(len(_journal_record(op)) for op in commit.prepared)
+                            commit.versions = (version, version + size)
+                            version += size
+                tracker.write(prepared)
+    except Exception as e:
+        # Nothing from this group is known to be on disk; every commit fails,
+        # and the tracker is rebuilt from the files on the next commit
+        if not isinstance(e, OSError):
+            with _lock:
+                _trackers.pop(path, None)
+        for commit in commits:
+            commit.error = commit.error or e
+    finally:
+        for commit in commits:
+            commit.done.set()
+
+
+def commit_ops(path, ops, history=None, compact=True):
+    # `history` is the state the ops apply to; it seeds the file when nothing
+    # is on disk yet. Returns the ops as written, with their new versions.
+    # Bulk writers pass compact=False for all but their last commit, so the
+    # journal is folded into the snapshot once rather than after every batch.
+    return _run_commit(path, ops, history, compact).prepared
+
+
+def commit_ops_versioned(path, ops, compact=True):
+    # (ops as written, version() just before them, version() just after),
+    # taken under the lock; a caller whose copy was at the first version is
+    # current at the second. The versions are None for a snapshot written by
+    # something other than this module.
+    commit = _run_commit(path, ops, None, compact)
+    return (commit.prepared, *commit.versions)
+
+
+def _run_commit(path, ops, history, compact):
+    if history is not None:
+        with _path_lock(path), _file_lock(path):
+            if not exists(path):
+                _write_snapshot(path, history, _generation(path) + 1)
+    commit = _Commit(list(ops))
+    with _lock:
+        queue = _pending.setdefault(path, [])
+        queue.append(commit)
+        leader = len(queue) == 1
+    if leader:
+        time.sleep(GROUP_COMMIT_WINDOW)
+        with _lock:
+            commits = _pending.pop(path)
+        _write_group(path, commits)
+    commit.done.wait()
+    if commit.error is not None:
+        raise commit.error
+    if compact:
+        _maybe_compact(path)
+    return commit
+
+
+def append_ops(path, ops, history=None):
+    # For callers that don't track versions: `history` is the in-memory state
+    # with `ops` already applied, and ops that lost a race are dropped.
+    # Returns the ops as written, or None if `history` was written instead.
+    if history is not None:
+        with _path_lock(path), _file_lock(path):
+            if not exists(path):
+                _write_snapshot(path, history, _generation(path) + 1)
+                return None
+    try:
+        return commit_ops(path, ops)
+    except ConflictError:
+        return []
+
+
+@metrics.timed("compact")
+def compact(path, force=False):
+    with _path_lock(path), _file_lock(path):
+        if not force and not os.path.exists(journal_path(path)):
+            return
+        with _lock:
+            tracker = _trackers.get(path)
+        if tracker is not None:
+            tracker.refresh()
+        _replace_snapshot(path, replay(_read_snapshot(path), _read_journal(path)), _generation(path))
+        if tracker is not None:
+            tracker.rebased()
+
+
+def _compact_in_background(path):
+    try:
+        compact(path)
+    finally:
+        with _lock:
+            _compacting.discard(path)
+
+
+def _maybe_compact(path):
+    try:
+        journal_size = os.path.getsize(journal_path(path))
+        snapshot_size = os.path.getsize(path) if os.path.exists(path) else 0
+    except OSError:
+        return
+    if journal_size < max(COMPACT_MIN_BYTES, snapshot_size * COMPACT_RATIO):
+        return
+    with _lock:
+        if path in _compacting:
+            return
+        _compacting.add(path)
+    threading.Thread(target=_compact_in_background, args=(path,), daemon=True).start()
+
+
+class _Index:
+    def __init__(self, f):
+        self._f = f
+        header = f.read(INDEX_HEADER.size)
+        magic, self.flags, self.count, self.snapshot_size = INDEX_HEADER.unpack(header)
+        if magic != INDEX_MAGIC:
+            raise ValueError("Not a history index")
+        self.generation = 0
+        self._entries = INDEX_HEADER.size
+        if self.flags & INDEX_GENERATION:
+            (self.generation,) = INDEX_GENERATION_FIELD.unpack(f.read(INDEX_GENERATION_FIELD.size))
+            self._entries += INDEX_GENERATION_FIELD.size
+        self._ordinals = None
+        if not self.flags & INDEX_SORTED:
+            # Ids out of order (as older files may be): look them up in a
+            # table read once from the index instead of binary searching
+            f.seek(self._entries)
+            data = f.read(self.count * INDEX_ENTRY.size)
+            self._ordinals = {
+                message_id: ordinal for ordinal, (message_id, _) in enumerate(INDEX_ENTRY.iter_unpack(data))
+            }
+
+    @property
+    def last_id(self):
+        if self._ordinals is not None:
+            return max(self._ordinals, default=0)
+        return self.entry(self.count - 1)[0] if self.count else 0
+
+    def entry(self, ordinal):
+        self._f.seek(self._entries + ordinal * INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack(self._f.read(INDEX_ENTRY.size))
+
+    def ordinal(self, message_id):
+        if self._ordinals is not None:
+            return self._ordinals.get(message_id)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[0] < message_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.entry(lo)[0] == message_id:
+            return lo
+        return None
+
+
+class HistoryPages:
+    # Page-level view over a snapshot plus the pending journal tail. Only the
+    # index entries and snapshot lines (or compressed blocks) of the requested
+    # page are read.
+
+    def __init__(self, path, index, reader):
+        self.path = path
+        self._index = index
+        self._reader = reader
+        self._edits = {}
+        self._deleted = set()
+        self._added = {}
+        for op in _read_journal(path):
+            self._apply(op)
+        self._deleted_ordinals = sorted(index.ordinal(i) for i in self._deleted)
+        self._deleted_set = set(self._deleted_ordinals)
+        self._snapshot_count = index.count - len(self._deleted_ordinals)
+        self.total = self._snapshot_count + len(self._added)
+
+    def _in_snapshot(self, message_id):
+        return message_id not in self._deleted and self._index.ordinal(message_id) is not None
+
+    def _apply(self, op):
+        kind = op["op"]
+        if kind == "add":
+            message_id = op["message"]["id"]
+            if message_id not in self._added and self._in_snapshot(message_id):
+                self._edits[message_id] = dict(op["message"])
+            else:
+                self._added[message_id] = op["message"]
+        elif kind == "edit":
+            message_id = op["id"]
+            if message_id in self._added:
+                self._added[message_id] = {**self._added[message_id], **op["fields"]}
+            elif self._in_snapshot(message_id):
+                self._edits.setdefault(message_id, {}).update(op["fields"])
+            else:
+                return
+            target = self._added.get(message_id) or self._edits[message_id]
+            if "version" in op:
+                target["version"] = op["version"]
+        elif kind == "delete":
+            message_id = op["id"]
+            if message_id in self._added:
+                del self._added[message_id]
+            elif self._in_snapshot(message_id):
+                self._deleted.add(message_id)
+                self._edits.pop(message_id, None)
+
+    @property
+    def next_id(self):
+        return max([self._index.last_id, *self._added]) + 1
+
+    @metrics.timed("read_page")
+    def read(self, start, count):
+        page = []
+        if start < self._snapshot_count:
+            ordinal = start
+            for deleted in self._deleted_ordinals:
+                if deleted > ordinal:
+                    break
+                ordinal += 1
+            while len(page) < count and ordinal < self._index.count:
+                if ordinal not in self._deleted_set:
+                    message = json.loads(self._reader.record(ordinal, self._index.entry(ordinal)[1]))
+                    if message["id"] in self._edits:
+                        message.update(self._edits[message["id"]])
+                    page.append(message)
+                ordinal += 1
+        if len(page) < count:
+            added = list(self._added.values())
+            added_start = max(0, start - self._snapshot_count)
+            page.extend(added[added_start:added_start + count - len(page)])
+        return page
+
+    def batches(self, batch_size):
+        for start in range(0, self.total, batch_size):
+            yield self.read(start, batch_size)
+
+
+def _open_pages(path):
+    # Both handles stay open, so later page reads see this snapshot even if a
+    # compaction replaces the files in the meantime.
+    try:
+        snapshot = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    try:
+        f = open(index_path(path), "rb")
+    except FileNotFoundError:
+        snapshot.close()
+        return None
+    try:
+        index = _Index(f)
+    except (struct.error, ValueError):
+        index = None
+    if index is None or index.snapshot_size != os.fstat(snapshot.fileno()).st_size:
+        f.close()
+        snapshot.close()
+        return None
+    try:
+        reader = _SegmentReader(snapshot) if index.flags & INDEX_SEGMENTED else _PlainReader(snapshot)
+    except (struct.error, ValueError):
+        f.close()
+        snapshot.close()
+        return None
+    return HistoryPages(path, index, reader)
+
+
+def open_pages(path, rewrite=True):
+    # With rewrite=False an unindexed snapshot is left alone and None returned
+    if not exists(path):
+        return None
+    with _path_lock(path):
+        with _file_lock(path, shared=True):
+            pages = _open_pages(path)
+        if pages is None and rewrite:
+            # Legacy or unindexed snapshot: rewrite it once in the indexed layout.
+            compact(path, force=True)
+            with _file_lock(path, shared=True):
+                pages = _open_pages(path)
+        return pages
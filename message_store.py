@@ -0,0 +1,125 @@
+import bisect
+from typing import Callable, Dict, Generic, Iterator, List, Optional, Tuple, TypeVar
+
+# Ordered, id-indexed message store.
+#
+# Messages are kept in a dict keyed by id; dicts preserve insertion order, so
+# iteration yields messages in conversation order while lookup, edit and
+# delete stay O(1). Ids come from a monotonic counter instead of max(ids).
+#
+# `version` goes up with every add, update and delete, so callers can key
+# caches (and HTTP validators) on it.
+#
+# Named sort orders can be registered as indexes: each keeps the sort keys of
+# every message in a sorted list, updated on add/update/delete, so page() can
+# seek straight to a keyset cursor instead of sorting the whole store.
+
+T = TypeVar("T")
+SortKey = Tuple
+
+
+class _SortedIndex(Generic[T]):
+    def __init__(self, key: Callable[[T], SortKey]):
+        self.key = key
+        self.keys: List[SortKey] = []
+
+    def add(self, message: T) -> None:
+        bisect.insort(self.keys, self.key(message))
+
+    def remove(self, key: SortKey) -> None:
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+
+
+class MessageStore(Generic[T]):
+    def __init__(self, messages=(), indexes: Optional[Dict[str, Callable[[T], SortKey]]] = None):
+        # Sort keys must end with the message id, so every key is unique
+        self._messages: Dict[int, T] = {}
+        self._next_id = 1
+        self.version = 0
+        self._indexes = {name: _SortedIndex(key) for name, key in (indexes or {}).items()}
+        for message in messages:
+            if message.id in self._messages:
+                raise KeyError(f"Message {message.id} already exists")
+            self._messages[message.id] = message
+            self._next_id = max(self._next_id, message.id + 1)
+        # One sort per index rather than an insort per message
+        for index in self._indexes.values():
+            index.keys = sorted(index.key(message) for message in self._messages.values())
+        self.version = len(self._messages)
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[T]:
+        return iter(self._messages.values())
+
+    def __contains__(self, message_id: int) -> bool:
+        return message_id in self._messages
+
+    def allocate_id(self) -> int:
+        message_id = self._next_id
+        self._next_id += 1
+        return message_id
+
+    def get(self, message_id: int) -> Optional[T]:
+        return self._messages.get(message_id)
+
+    def add(self, message: T) -> T:
+        if message.id in self._messages:
+            raise KeyError(f"Message {message.id} already exists")
+        self._messages[message.id] = message
+        self._next_id = max(self._next_id, message.id + 1)
+        for index in self._indexes.values():
+            index.add(message)
+        self.version += 1
+        return message
+
+    def update(self, message_id: int, **fields) -> Optional[T]:
+        message = self._messages.get(message_id)
+        if message is not None:
+            old_keys = {name: index.key(message) for name, index in self._indexes.items()}
+            for name, value in fields.items():
+                setattr(message, name, value)
+            for name, index in self._indexes.items():
+                if index.key(message) != old_keys[name]:
+                    index.remove(old_keys[name])
+                    index.add(message)
+            self.version += 1
+        return message
+
+    def delete(self, message_id: int) -> bool:
+        message = self._messages.pop(message_id, None)
+        if message is None:
+            return False
+        for index in self._indexes.values():
+            index.remove(index.key(message))
+        self.version += 1
+        return True
+
+    def page(
+        self,
+        index: str,
+        limit: int,
+        after: Optional[SortKey] = None,
+        before: Optional[SortKey] = None,
+        where: Optional[Callable[[T], bool]] = None,
+    ) -> Tuple[List[T], bool]:
+        # Up to `limit` messages in `index` order strictly after (or before)
+        # the cursor key, plus whether more matching messages lie beyond them.
+        # Cursors are sort keys, so pages stay stable while messages are added
+        # or deleted elsewhere.
+        keys = self._indexes[index].keys
+        if before is not None:
+            positions = range(bisect.bisect_left(keys, tuple(before)) - 1, -1, -1)
+        else:
+            positions = range(bisect.bisect_right(keys, tuple(after)) if after is not None else 0, len(keys))
+        page = []
+        for position in positions:
+            message = self._messages[keys[position][-1]]
+            if where is None or where(message):
+                if len(page) == limit:
+                    return (page[::-1] if before is not None else page), True
+                page.append(message)
+        return (page[::-1] if before is not None else page), False
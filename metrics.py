@@ -0,0 +1,152 @@
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from collections import defaultdict
+
+# Process-wide timing and byte counters for the conversation-history hot paths.
+#
+# Wrap an operation with `timed("name")`, as a decorator (sync or async) or as
+# a context manager. Each completed operation feeds a latency histogram, and
+# bytes reported with record_bytes() while it runs are charged to it (the
+# innermost one, when operations nest). render() produces the Prometheus text
+# format for a /metrics route.
+#
+# For per-request (per-rerun) breakdowns, call begin_run() at the start of the
+# request; run_timings() then lists what was timed since. Both the nesting and
+# the run are tracked in context variables, so concurrent asyncio tasks and
+# threads each see their own.
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PREFIX = "conversation"
+
+_lock = threading.Lock()
+_histograms = {}  # operation -> _Histogram
+_bytes_read = defaultdict(int)
+_bytes_written = defaultdict(int)
+_frames = contextvars.ContextVar("metrics_frames", default=())
+_run = contextvars.ContextVar("metrics_run", default=None)
+
+
+class _Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+
+
+def observe(operation, seconds, read=0, written=0):
+    with _lock:
+        histogram = _histograms.get(operation)
+        if histogram is None:
+            histogram = _histograms[operation] = _Histogram()
+        histogram.observe(seconds)
+    run = _run.get()
+    if run is not None:
+        run.append({"operation": operation, "seconds": seconds, "read": read, "written": written})
+
+
+def record_bytes(read=0, written=0, operation=None):
+    # Charged to the innermost timed operation unless `operation` is given
+    frames = _frames.get()
+    if operation is None:
+        operation = frames[-1]["operation"] if frames else "other"
+        if frames:
+            frames[-1]["read"] += read
+            frames[-1]["written"] += written
+    with _lock:
+        if read:
+            _bytes_read[operation] += read
+        if written:
+            _bytes_written[operation] += written
+
+
+class timed:
+    def __init__(self, operation):
+        self.operation = operation
+
+    def __enter__(self):
+        frame = {"operation": self.operation, "start": time.perf_counter(), "read": 0, "written": 0}
+        frame["token"] = _frames.set(_frames.get() + (frame,))
+        return self
+
+    def __exit__(self, *exc_info):
+        frame = _frames.get()[-1]
+        _frames.reset(frame["token"])
+        observe(self.operation, time.perf_counter() - frame["start"], frame["read"], frame["written"])
+        return False
+
+    def __call__(self, fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with timed(self.operation):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with timed(self.operation):
+                    return fn(*args, **kwargs)
+        return wrapper
+
+
+def begin_run():
+    _run.set([])
+
+
+def run_timings():
+    return list(_run.get() or [])
+
+
+def summary():
+    # operation -> {"count", "seconds", "read", "written"}
+    with _lock:
+        operations = set(_histograms) | set(_bytes_read) | set(_bytes_written)
+        return {
+            operation: {
+                "count": _histograms[operation].count if operation in _histograms else 0,
+                "seconds": _histograms[operation].sum if operation in _histograms else 0.0,
+                "read": _bytes_read.get(operation, 0),
+                "written": _bytes_written.get(operation, 0),
+            }
+            for operation in sorted(operations)
+        }
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render():
+    lines = [
+        f"# HELP {PREFIX}_operation_seconds Time spent in conversation-history operations.",
+        f"# TYPE {PREFIX}_operation_seconds histogram",
+    ]
+    with _lock:
+        for operation, histogram in sorted(_histograms.items()):
+            label = f'operation="{_label(operation)}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.buckets):
+                cumulative += count
+                lines.append(f'{PREFIX}_operation_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{PREFIX}_operation_seconds_bucket{{{label},le="+Inf"}} {histogram.count}')
+            lines.append(f"{PREFIX}_operation_seconds_sum{{{label}}} {histogram.sum}")
+            lines.append(f"{PREFIX}_operation_seconds_count{{{label}}} {histogram.count}")
+        for name, counters, help_text in (
+            ("bytes_read_total", _bytes_read, "Bytes read from storage, by operation."),
+            ("bytes_written_total", _bytes_written, "Bytes written to storage or clients, by operation."),
+        ):
+            lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}_{name} counter")
+            for operation, value in sorted(counters.items()):
+                lines.append(f'{PREFIX}_{name}{{operation="{_label(operation)}"}} {value}')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import zlib
+
+import metrics
+from history_store import _file_lock
+
+# Content-addressed store for saved snapshots (applications, finished Chainlit
+# conversations).
+#
+# Messages are cut into chunks at content-defined boundaries: a chunk ends
+# after a message whose hash hits CHUNK_BOUNDARY, so inserting or deleting a
+# message only changes the chunk around it and every other chunk keeps its
+# hash. Chunks live under chunks/<sha256[:2]>/<sha256> and are written once;
+# a snapshot is a small manifest listing its chunk hashes. Snapshots sharing
+# most of their messages therefore share most of their bytes on disk.
+#
+#   root/
+#     chunks/ab/ab12...   one JSON message per line
+#     manifests/<name>.json
+#
+# collect_garbage() removes chunks no manifest refers to. Saves take a shared
+# lock on the store and garbage collection an exclusive one, so a chunk that a
+# save is about to reference is never collected under it. Saves don't exclude
+# each other: chunks are written once under their hash and the manifest is
+# swapped in with a rename. flock locks belong to the open file description,
+# and each lock opens the lock file afresh, so threads of one process take
+# part the same way separate processes do.
+
+SNAPSHOT_DIR = "snapshots"
+CHUNK_BOUNDARY = 64  # Average messages per chunk
+CHUNK_MIN_MESSAGES = 16
+CHUNK_MAX_MESSAGES = 256
+
+_SNAPSHOT_NAME = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+def _check_name(name):
+    if not _SNAPSHOT_NAME.match(name) or name.startswith("."):
+        raise ValueError(f"Invalid snapshot name: {name!r}")
+
+
+def _manifest_path(root, name):
+    _check_name(name)
+    return os.path.join(root, "manifests", f"{name}.json")
+
+
+def _chunk_path(root, digest):
+    return os.path.join(root, "chunks", digest[:2], digest)
+
+
+def _write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    metrics.record_bytes(written=len(data))
+    os.replace(tmp_path, path)
+
+
+def _chunks(messages):
+    lines = []
+    for message in messages:
+        line = json.dumps(message).encode("utf-8") + b"\n"
+        lines.append(line)
+        if len(lines) >= CHUNK_MAX_MESSAGES or (
+            len(lines) >= CHUNK_MIN_MESSAGES and zlib.crc32(line) % CHUNK_BOUNDARY == 0
+        ):
+            yield lines
+            lines = []
+    if lines:
+        yield lines
+
+
+def _store_chunk(root, lines):
+    data = b"".join(lines)
+    digest = hashlib.sha256(data).hexdigest()
+    path = _chunk_path(root, digest)
+    if not os.path.exists(path):
+        _write_file(path, data)
+    return digest
+
+
+def save_snapshot(root, name, messages, meta=None, progress=None):
+    # `messages` may be any iterable, so a snapshot can be written straight
+    # from storage batches. progress(count) is called after each chunk.
+    os.makedirs(root, exist_ok=True)
+    digests = []
+    count = 0
+    with _file_lock(root, shared=True):
+        for lines in _chunks(messages):
+            digests.append(_store_chunk(root, lines))
+            count += len(lines)
+            if progress is not None:
+                progress(count)
+        manifest = {"name": name, "meta": meta or {}, "count": count, "chunks": digests}
+        _write_file(_manifest_path(root, name), json.dumps(manifest).encode("utf-8"))
+    return manifest
+
+
+def load_manifest(root, name):
+    try:
+        with open(_manifest_path(root, name), "rb") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def iter_snapshot(root, name):
+    manifest = load_manifest(root, name)
+    if manifest is None:
+        raise KeyError(f"No snapshot named {name!r}")
+    for digest in manifest["chunks"]:
+        with open(_chunk_path(root, digest), "rb") as f:
+            data = f.read()
+        metrics.record_bytes(read=len(data))
+        for line in data.splitlines():
+            yield json.loads(line)
+
+
+def load_snapshot(root, name):
+    # Rebuilds the full snapshot: (meta, messages)
+    manifest = load_manifest(root, name)
+    if manifest is None:
+        return None
+    return manifest["meta"], list(iter_snapshot(root, name))
+
+
+def list_snapshots(root):
+    try:
+        names = os.listdir(os.path.join(root, "manifests"))
+    except FileNotFoundError:
+        return []
+    return sorted(name[:-len(".json")] for name in names if name.endswith(".json"))
+
+
+def delete_snapshot(root, name):
+    try:
+        os.unlink(_manifest_path(root, name))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def collect_garbage(root):
+    # Mark every chunk a manifest refers to, then sweep the rest. Returns the
+    # number of chunks removed.
+    if not os.path.isdir(root):
+        return 0
+    removed = 0
+    with _file_lock(root):
+        referenced = set()
+        for name in list_snapshots(root):
+            manifest = load_manifest(root, name)
+            if manifest is not None:
+                referenced.update(manifest["chunks"])
+        chunks_dir = os.path.join(root, "chunks")
+        for prefix in os.listdir(chunks_dir) if os.path.isdir(chunks_dir) else ():
+            for digest in os.listdir(os.path.join(chunks_dir, prefix)):
+                if digest not in referenced:
+                    os.unlink(os.path.join(chunks_dir, prefix, digest))
+                    removed += 1
+    return removed
@@ -1,15 +1,21 @@
 import streamlit as st
-import pandas as pd
-import json
-import os
+import history_export
+import conversation_storage
+import metrics
+import streamlit_ui
 
 # File to store the conversation history
 HISTORY_FILE = "conversation_history.json"
+CONVERSATION_ID = conversation_storage.DEFAULT_CONVERSATION
+AUTOSAVE_SECONDS = 10  # Autosave interval when it is switched on
+VISIBLE_ROWS = 20  # Message rows that get widgets at a time
+
+storage = conversation_storage.open_storage(f"file:{HISTORY_FILE}")
 
 def load_history():
-    if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, "r") as f:
-            return json.load(f)
+    history = storage.load_history(CONVERSATION_ID)
+    if history is not None:
+        return history
     return [
         {"id": 1, "sender": "User", "content": "Write a Python function to calculate factorial."},
         {"id": 2, "sender": "Coder", "content": "Here's a Python function to calculate factorial:"},
@@ -19,14 +25,67 @@ def load_history():
     ]
 
 def save_history(history):
-    with open(HISTORY_FILE, "w") as f:
-        json.dump(history, f)
+    storage.save_history(CONVERSATION_ID, history)
+
+def save_changes(history, *ops):
+    return streamlit_ui.save_changes(storage, CONVERSATION_ID, ops, history)
+
+def visible_rows(history):
+    # Only the rows in view are built as widgets; the scroll position picks
+    # which slice of the history that is.
+    last_row = max(1, len(history))
+    if st.session_state.get("first_row", 1) > last_row:
+        st.session_state.first_row = last_row  # The history shrank since the last run
+    first_row = st.number_input("Scroll to message", min_value=1, max_value=last_row,
+                                step=VISIBLE_ROWS, key="first_row")
+    return history[first_row - 1:first_row - 1 + VISIBLE_ROWS]
+
+def save_edits(history, message_ids=None):
+    return streamlit_ui.save_edits(storage, CONVERSATION_ID, history, message_ids)
+
+@st.fragment(run_every=AUTOSAVE_SECONDS)
+def autosave(history):
+    saved = save_edits(history)
+    if saved:
+        st.toast(f"Autosaved {saved} changes")
+
+@st.fragment
+def message_row(history, message):
+    # Each row is its own fragment, so Save only reruns this row. Delete
+    # shifts the rows below it and reruns the app once.
+    col1, col2, col3 = st.columns([3, 1, 1])
+
+    with col1:
+        new_content = st.text_area(f"Message {message['id']} - {message['sender']}", 
+                                   value=streamlit_ui.edited_content(message), 
+                                   key=f"message_{message['id']}", 
+                                   height=100)
+        streamlit_ui.track_edit(message, new_content)
+
+    with col2:
+        if st.button("✏️ Save", key=f"save_{message['id']}"):
+            save_edits(history, [message['id']])
+            st.success("Changes saved!")
+
+    if message['id'] in streamlit_ui.unsaved_edits():
+        col1.caption("● Unsaved changes")
+
+    with col3:
+        if st.button("🗑️ Delete", key=f"delete_{message['id']}"):
+            if save_changes(history, conversation_storage.delete_op(
+                    message['id'], base_version=conversation_storage.message_version(message))):
+                streamlit_ui.unsaved_edits().pop(message['id'], None)
+                st.rerun()
+            else:
+                streamlit_ui.reload_after_conflict()
 
 def main():
     st.set_page_config(page_title="Conversation History", layout="wide")
     st.title("Conversation History")
+    metrics.begin_run()
 
     history = load_history()
+    streamlit_ui.show_conflict()
 
     # Create a container for messages
     messages_container = st.container()
@@ -38,48 +97,47 @@ def main():
     new_content = st.text_area("Content")
     if st.button("➕ Add Message"):
         new_id = max([m['id'] for m in history], default=0) + 1
-        history.append({
+        new_message = {
             "id": new_id,
             "sender": new_sender,
             "content": new_content
-        })
-        save_history(history)
-        st.success("New message added!")
-
-    # Export to CSV
-    if st.button("📁 Export to CSV"):
-        df = pd.DataFrame(history)
-        csv = df.to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="⬇️ Download CSV",
-            data=csv,
-            file_name="conversation_history.csv",
-            mime="text/csv",
-        )
+        }
+        saved = save_changes(history, conversation_storage.add_op(new_message))
+        if saved:
+            history.append(saved[0]['message'])
+            st.success("New message added!")
+        else:
+            streamlit_ui.reload_after_conflict()
+
+    # Export
+    export_format = st.selectbox("Export format", history_export.available_formats())
+    if st.button("📁 Export"):
+        data, file_name, mime = history_export.export_history(history_export.batched(history), export_format)
+        with data:
+            st.download_button(
+                label=f"⬇️ Download {export_format}",
+                data=data,
+                file_name=file_name,
+                mime=mime,
+            )
+
+    # Unsaved edits
+    col1, col2, col3 = st.columns([1, 1, 3])
+    with col1:
+        if st.button("💾 Save all"):
+            st.success(f"Saved {save_edits(history)} changes!")
+    with col2:
+        if st.checkbox(f"Autosave every {AUTOSAVE_SECONDS}s", key="autosave"):
+            autosave(history)
+    with col3:
+        st.write(f"{len(streamlit_ui.unsaved_edits())} unsaved changes")
 
     # Display and manage messages
     with messages_container:
-        for i, message in enumerate(history):
-            col1, col2, col3 = st.columns([3, 1, 1])
-            
-            with col1:
-                new_content = st.text_area(f"Message {message['id']} - {message['sender']}", 
-                                           value=message['content'], 
-                                           key=f"message_{message['id']}", 
-                                           height=100)
-            
-            with col2:
-                if st.button("✏️ Save", key=f"save_{message['id']}"):
-                    history[i]['content'] = new_content
-                    save_history(history)
-                    st.success("Changes saved!")
-            
-            with col3:
-                if st.button("🗑️ Delete", key=f"delete_{message['id']}"):
-                    history = [m for m in history if m['id'] != message['id']]
-                    save_history(history)
-                    st.success("Message deleted!")
-                    st.experimental_rerun()
+        for message in visible_rows(history):
+            message_row(history, message)
+
+    streamlit_ui.show_metrics()
 
 if __name__ == "__main__":
     main()
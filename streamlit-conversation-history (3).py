@@ -1,17 +1,22 @@
 import streamlit as st
-import pandas as pd
-import json
-import os
 import math
+import history_export
+import conversation_storage
+import metrics
+import streamlit_ui
 
 # File to store the conversation history
 HISTORY_FILE = "conversation_history.json"
 MESSAGES_PER_PAGE = 5  # Number of messages to display per page
+CONVERSATION_ID = conversation_storage.DEFAULT_CONVERSATION
+AUTOSAVE_SECONDS = 10  # Autosave interval when it is switched on
+
+storage = conversation_storage.open_storage(f"file:{HISTORY_FILE}")
 
 def load_history():
-    if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, "r") as f:
-            return json.load(f)
+    history = storage.load_history(CONVERSATION_ID)
+    if history is not None:
+        return history
     return [
         {"id": 1, "sender": "User", "content": "Write a Python function to calculate factorial."},
         {"id": 2, "sender": "Coder", "content": "Here's a Python function to calculate factorial:"},
@@ -36,17 +41,85 @@ def load_history():
     ]
 
 def save_history(history):
-    with open(HISTORY_FILE, "w") as f:
-        json.dump(history, f)
+    storage.save_history(CONVERSATION_ID, history)
+
+def save_changes(*ops):
+    return streamlit_ui.save_changes(storage, CONVERSATION_ID, ops)
+
+def load_pages():
+    if not storage.exists(CONVERSATION_ID):
+        save_history(load_history())  # Persist the seed conversation so it can be paged
+    return storage.open_pages(CONVERSATION_ID)
+
+def add_message(sender, content):
+    # Takes the next id; if another session takes it first, the message goes
+    # after theirs instead.
+    while True:
+        message = {"id": load_pages().next_id, "sender": sender, "content": content}
+        saved = save_changes(conversation_storage.add_op(message))
+        if saved is not None:
+            return saved[0]['message']
+
+def save_edits(message_ids=None):
+    return streamlit_ui.save_edits(storage, CONVERSATION_ID, message_ids=message_ids)
+
+@st.fragment(run_every=AUTOSAVE_SECONDS)
+def autosave():
+    saved = save_edits()
+    if saved:
+        st.toast(f"Autosaved {saved} changes")
+
+@st.fragment
+def message_row(message):
+    # Each row is its own fragment, so Save only reruns this row. Delete
+    # shifts the page and reruns the app once.
+    col1, col2, col3 = st.columns([3, 1, 1])
+
+    with col1:
+        new_content = st.text_area(f"Message {message['id']} - {message['sender']}", 
+                                   value=streamlit_ui.edited_content(message), 
+                                   key=f"message_{message['id']}", 
+                                   height=100)
+        streamlit_ui.track_edit(message, new_content)
+
+    with col2:
+        if st.button("✏️ Save", key=f"save_{message['id']}"):
+            save_edits([message['id']])
+            st.success("Changes saved!")
+
+    if message['id'] in streamlit_ui.unsaved_edits():
+        col1.caption("● Unsaved changes")
+
+    with col3:
+        if st.button("🗑️ Delete", key=f"delete_{message['id']}"):
+            if save_changes(conversation_storage.delete_op(
+                    message['id'], base_version=conversation_storage.message_version(message))):
+                streamlit_ui.unsaved_edits().pop(message['id'], None)
+                st.rerun()
+            else:
+                streamlit_ui.reload_after_conflict()
 
 def main():
     st.set_page_config(page_title="Conversation History", layout="wide")
     st.title("Conversation History")
+    metrics.begin_run()
+
+    pages = load_pages()
+    streamlit_ui.show_conflict()
 
-    history = load_history()
+    # Unsaved edits
+    col1, col2, col3 = st.columns([1, 1, 3])
+    with col1:
+        if st.button("💾 Save all"):
+            st.success(f"Saved {save_edits()} changes!")
+    with col2:
+        if st.checkbox(f"Autosave every {AUTOSAVE_SECONDS}s", key="autosave"):
+            autosave()
+    with col3:
+        st.write(f"{len(streamlit_ui.unsaved_edits())} unsaved changes")
 
     # Pagination
-    total_pages = math.ceil(len(history) / MESSAGES_PER_PAGE)
+    total_pages = math.ceil(pages.total / MESSAGES_PER_PAGE)
     col1, col2, col3 = st.columns([1, 3, 1])
     with col1:
         if "page" not in st.session_state:
@@ -60,31 +133,11 @@ def main():
             st.session_state.page = min(total_pages, st.session_state.page + 1)
 
     start_idx = (st.session_state.page - 1) * MESSAGES_PER_PAGE
-    end_idx = start_idx + MESSAGES_PER_PAGE
-    page_history = history[start_idx:end_idx]
+    page_history = pages.read(start_idx, MESSAGES_PER_PAGE)
 
     # Display and manage messages
-    for i, message in enumerate(page_history, start=start_idx):
-        col1, col2, col3 = st.columns([3, 1, 1])
-        
-        with col1:
-            new_content = st.text_area(f"Message {message['id']} - {message['sender']}", 
-                                       value=message['content'], 
-                                       key=f"message_{message['id']}", 
-                                       height=100)
-        
-        with col2:
-            if st.button("✏️ Save", key=f"save_{message['id']}"):
-                history[i]['content'] = new_content
-                save_history(history)
-                st.success("Changes saved!")
-        
-        with col3:
-            if st.button("🗑️ Delete", key=f"delete_{message['id']}"):
-                history = [m for m in history if m['id'] != message['id']]
-                save_history(history)
-                st.success("Message deleted!")
-                st.experimental_rerun()
+    for message in page_history:
+        message_row(message)
 
     st.markdown("---")
 
@@ -93,27 +146,24 @@ def main():
     new_sender = st.selectbox("Sender", ["User", "Coder"])
     new_content = st.text_area("Content")
     if st.button("➕ Add Message"):
-        new_id = max([m['id'] for m in history], default=0) + 1
-        history.append({
-            "id": new_id,
-            "sender": new_sender,
-            "content": new_content
-        })
-        save_history(history)
+        add_message(new_sender, new_content)
         st.session_state.page = total_pages + 1  # Move to the new last page
         st.success("New message added!")
-        st.experimental_rerun()
-
-    # Export to CSV
-    if st.button("📁 Export to CSV"):
-        df = pd.DataFrame(history)
-        csv = df.to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="⬇️ Download CSV",
-            data=csv,
-            file_name="conversation_history.csv",
-            mime="text/csv",
-        )
+        st.rerun()
+
+    # Export
+    export_format = st.selectbox("Export format", history_export.available_formats())
+    if st.button("📁 Export"):
+        data, file_name, mime = history_export.export_history(load_pages().batches(history_export.EXPORT_BATCH_SIZE), export_format)
+        with data:
+            st.download_button(
+                label=f"⬇️ Download {export_format}",
+                data=data,
+                file_name=file_name,
+                mime=mime,
+            )
+
+    streamlit_ui.show_metrics()
 
 if __name__ == "__main__":
     main()
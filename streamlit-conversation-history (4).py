@@ -1,18 +1,24 @@
 import streamlit as st
-import pandas as pd
-import json
-import os
 import math
-import time
+import application_jobs
+import history_export
+import conversation_storage
+import metrics
+import streamlit_ui
 
 # File to store the conversation history
 HISTORY_FILE = "conversation_history.json"
 MESSAGES_PER_PAGE = 5  # Number of messages to display per page
+CONVERSATION_ID = conversation_storage.DEFAULT_CONVERSATION
+AUTOSAVE_SECONDS = 10  # Autosave interval when it is switched on
+JOB_POLL_SECONDS = 1  # How often running application exports are polled
+
+storage = conversation_storage.open_storage(f"file:{HISTORY_FILE}")
 
 def load_history():
-    if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, "r") as f:
-            return json.load(f)
+    history = storage.load_history(CONVERSATION_ID)
+    if history is not None:
+        return history
     return [
         {"id": 1, "sender": "User", "content": "Write a Python function to calculate factorial."},
         {"id": 2, "sender": "Coder", "content": "Here's a Python function to calculate factorial:"},
@@ -23,25 +29,106 @@ def load_history():
     ]
 
 def save_history(history):
-    with open(HISTORY_FILE, "w") as f:
-        json.dump(history, f)
+    storage.save_history(CONVERSATION_ID, history)
+
+def save_changes(history, *ops):
+    return streamlit_ui.save_changes(storage, CONVERSATION_ID, ops, history)
+
+def save_edits(message_ids=None):
+    return streamlit_ui.save_edits(storage, CONVERSATION_ID, st.session_state.history, message_ids)
+
+@st.fragment(run_every=AUTOSAVE_SECONDS)
+def autosave():
+    saved = save_edits()
+    if saved:
+        st.toast(f"Autosaved {saved} changes")
+
+@st.fragment
+def message_row(message):
+    # Each row is its own fragment, so Save only reruns this row. Delete
+    # shifts the page and reruns the app once.
+    col1, col2, col3 = st.columns([3, 1, 1])
+
+    with col1:
+        new_content = st.text_area(f"Message {message['id']} - {message['sender']}", 
+                                   value=streamlit_ui.edited_content(message), 
+                                   key=f"message_{message['id']}", 
+                                   height=100)
+        streamlit_ui.track_edit(message, new_content)
+
+    with col2:
+        if st.button("✏️ Save", key=f"save_{message['id']}"):
+            save_edits([message['id']])
+            st.success("Changes saved!")
+
+    if message['id'] in streamlit_ui.unsaved_edits():
+        col1.caption("● Unsaved changes")
+
+    with col3:
+        if st.button("🗑️ Delete", key=f"delete_{message['id']}"):
+            if save_changes(st.session_state.history, conversation_storage.delete_op(
+                    message['id'], base_version=conversation_storage.message_version(message))):
+                st.session_state.history = [m for m in st.session_state.history if m['id'] != message['id']]
+                streamlit_ui.unsaved_edits().pop(message['id'], None)
+                st.rerun()
+            else:
+                streamlit_ui.reload_after_conflict()
+
+@st.cache_resource
+def job_runner():
+    # One pool for every session, so exports queue up instead of piling on
+    return application_jobs.JobRunner()
 
 def save_application(history, app_name):
-    app_data = {
-        "appName": app_name,
-        "conversation": history
-    }
-    filename = f"{app_name.replace(' ', '_')}_application.json"
-    with open(filename, "w") as f:
-        json.dump(app_data, f, indent=2)
-    return filename
+    # Queues the export and returns its job. The messages are copied first
+    # because edits update the session's dicts in place.
+    return job_runner().submit(app_name, application_jobs.write_application, [dict(m) for m in history], app_name)
+
+def show_application_job(job):
+    if job.status == application_jobs.FAILED:
+        st.error(f"Creating {job.name} failed: {job.error}")
+    elif job.status == application_jobs.DONE:
+        st.success(f"Application {job.result} saved")
+        # The document is rebuilt from the snapshot only when asked for
+        if st.button(f"📄 Export {job.result}.json", key=f"export_application_{job.id}"):
+            filename = application_jobs.export_application(job.result)
+            with open(filename, "rb") as f:
+                st.download_button(
+                    label=f"⬇️ Download {filename}", data=f, file_name=filename,
+                    mime="application/json", key=f"download_application_{job.id}",
+                )
+    else:
+        st.progress(job.progress, text=f"Creating {job.name} ({job.status})...")
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def application_job_progress(job_ids):
+    # Polls this session's exports; once they have all finished the app reruns
+    # and shows the results without polling.
+    jobs = [job for job in map(job_runner().get, job_ids) if job is not None]
+    for job in jobs:
+        show_application_job(job)
+    if all(job.finished for job in jobs):
+        st.rerun()
 
 def main():
     st.set_page_config(page_title="Conversation History", layout="wide")
     st.title("Conversation History")
+    metrics.begin_run()
 
     if 'history' not in st.session_state:
         st.session_state.history = load_history()
+    streamlit_ui.show_conflict()
+
+    # Unsaved edits
+    col1, col2, col3 = st.columns([1, 1, 3])
+    with col1:
+        if st.button("💾 Save all"):
+            st.success(f"Saved {save_edits()} changes!")
+    with col2:
+        if st.checkbox(f"Autosave every {AUTOSAVE_SECONDS}s", key="autosave"):
+            autosave()
+    with col3:
+        st.write(f"{len(streamlit_ui.unsaved_edits())} unsaved changes")
 
     # Pagination
     total_pages = math.ceil(len(st.session_state.history) / MESSAGES_PER_PAGE)
@@ -63,26 +150,7 @@ def main():
 
     # Display and manage messages
     for message in page_history:
-        col1, col2, col3 = st.columns([3, 1, 1])
-        
-        with col1:
-            new_content = st.text_area(f"Message {message['id']} - {message['sender']}", 
-                                       value=message['content'], 
-                                       key=f"message_{message['id']}", 
-                                       height=100)
-        
-        with col2:
-            if st.button("✏️ Save", key=f"save_{message['id']}"):
-                message['content'] = new_content
-                save_history(st.session_state.history)
-                st.success("Changes saved!")
-        
-        with col3:
-            if st.button("🗑️ Delete", key=f"delete_{message['id']}"):
-                st.session_state.history = [m for m in st.session_state.history if m['id'] != message['id']]
-                save_history(st.session_state.history)
-                st.success("Message deleted!")
-                st.experimental_rerun()
+        message_row(message)
 
     st.markdown("---")
 
@@ -92,26 +160,31 @@ def main():
     new_content = st.text_area("Content")
     if st.button("➕ Add Message"):
         new_id = max([m['id'] for m in st.session_state.history], default=0) + 1
-        st.session_state.history.append({
+        new_message = {
             "id": new_id,
             "sender": new_sender,
             "content": new_content
-        })
-        save_history(st.session_state.history)
-        st.session_state.page = total_pages + 1  # Move to the new last page
-        st.success("New message added!")
-        st.experimental_rerun()
-
-    # Export to CSV
-    if st.button("📁 Export to CSV"):
-        df = pd.DataFrame(st.session_state.history)
-        csv = df.to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="⬇️ Download CSV",
-            data=csv,
-            file_name="conversation_history.csv",
-            mime="text/csv",
-        )
+        }
+        saved = save_changes(st.session_state.history, conversation_storage.add_op(new_message))
+        if saved:
+            st.session_state.history.append(saved[0]['message'])
+            st.session_state.page = total_pages + 1  # Move to the new last page
+            st.success("New message added!")
+            st.rerun()
+        else:
+            streamlit_ui.reload_after_conflict()
+
+    # Export
+    export_format = st.selectbox("Export format", history_export.available_formats())
+    if st.button("📁 Export"):
+        data, file_name, mime = history_export.export_history(history_export.batched(st.session_state.history), export_format)
+        with data:
+            st.download_button(
+                label=f"⬇️ Download {export_format}",
+                data=data,
+                file_name=file_name,
+                mime=mime,
+            )
 
     # Application button and functionality
     st.markdown("---")
@@ -122,6 +195,8 @@ def main():
         st.session_state.show_popup = False
     if 'app_name' not in st.session_state:
         st.session_state.app_name = ""
+    if 'application_jobs' not in st.session_state:
+        st.session_state.application_jobs = []
 
     # Button to show pop-up
     if st.button("📄 Create Application"):
@@ -135,14 +210,28 @@ def main():
 
             if submit_button:
                 if st.session_state.app_name:
-                    with st.spinner('Creating application...'):
-                        filename = save_application(st.session_state.history, st.session_state.app_name)
-                        time.sleep(2)  # Simulating some processing time
-                    st.success(f"Application saved as {filename}")
+                    job = save_application(st.session_state.history, st.session_state.app_name)
+                    st.session_state.application_jobs.append(job.id)
                     st.session_state.show_popup = False
                     st.session_state.app_name = ""
                 else:
                     st.error("Please enter an application name")
 
+    # Application exports run in the background; this session's jobs are
+    # polled until they finish
+    jobs = [job for job in map(job_runner().get, st.session_state.application_jobs) if job is not None]
+    if any(not job.finished for job in jobs):
+        application_job_progress([job.id for job in jobs])
+    elif jobs:
+        for job in jobs:
+            show_application_job(job)
+        if st.button("Clear finished exports"):
+            for job in jobs:
+                job_runner().discard(job.id)
+            st.session_state.application_jobs = []
+            st.rerun()
+
+    streamlit_ui.show_metrics()
+
 if __name__ == "__main__":
     main()
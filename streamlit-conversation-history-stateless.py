@@ -1,16 +1,20 @@
 import streamlit as st
-import pandas as pd
-import json
-import os
+import history_export
+import conversation_storage
+import metrics
+import streamlit_ui
 
 # File to store the conversation history
 HISTORY_FILE = "conversation_history.json"
+CONVERSATION_ID = conversation_storage.DEFAULT_CONVERSATION
+VISIBLE_ROWS = 20  # Message rows that get widgets at a time
+
+storage = conversation_storage.open_storage(f"file:{HISTORY_FILE}")
 
-@st.cache_data
 def load_history():
-    if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, "r") as f:
-            return json.load(f)
+    history = storage.load_history(CONVERSATION_ID)
+    if history is not None:
+        return history
     return [
         {"id": 1, "sender": "User", "content": "Write a Python function to calculate factorial."},
         {"id": 2, "sender": "Coder", "content": "Here's a Python function to calculate factorial:"},
@@ -20,42 +24,68 @@ def load_history():
     ]
 
 def save_history(history):
-    with open(HISTORY_FILE, "w") as f:
-        json.dump(history, f)
+    storage.save_history(CONVERSATION_ID, history)
+
+def save_changes(history, *ops):
+    # `history` is the conversation before `ops`; it only seeds the file the
+    # first time something is saved.
+    seed = None if storage.exists(CONVERSATION_ID) else conversation_storage.replay(history, ops)
+    storage.append_ops(CONVERSATION_ID, ops, seed)
+
+@st.cache_resource(max_entries=2)
+def load_cached_history(version):
+    # One copy per file version, shared by every session without copying.
+    # It is never mutated in place: conversation_storage.replay copies only the
+    # messages an edit touches.
+    return tuple(load_history())
+
+def visible_rows(history):
+    # Only the rows in view are built as widgets; the scroll position picks
+    # which slice of the history that is.
+    last_row = max(1, len(history))
+    if st.session_state.get("first_row", 1) > last_row:
+        st.session_state.first_row = last_row  # The history shrank since the last run
+    first_row = st.number_input("Scroll to message", min_value=1, max_value=last_row,
+                                step=VISIBLE_ROWS, key="first_row")
+    return history[first_row - 1:first_row - 1 + VISIBLE_ROWS]
+
+@st.fragment
+def message_row(history, message):
+    # Each row is its own fragment: typing or pressing Save reruns only this
+    # row. The cached history is shared and stays unchanged until the next
+    # full run, so the last saved content is remembered per session.
+    saved_key = f"saved_{message['id']}"
+    col1, col2, col3 = st.columns([3, 1, 1])
+    
+    with col1:
+        new_content = st.text_area(f"Message {message['id']} - {message['sender']}", 
+                                   value=message['content'], 
+                                   key=f"message_{message['id']}", 
+                                   height=100)
+        if new_content != st.session_state.get(saved_key, message['content']):
+            save_changes(history, conversation_storage.edit_op(message['id'], content=new_content))
+            st.session_state[saved_key] = new_content
+    
+    with col2:
+        if st.button("✏️ Save", key=f"save_{message['id']}"):
+            st.success("Changes saved!")
+    
+    with col3:
+        if st.button("🗑️ Delete", key=f"delete_{message['id']}"):
+            save_changes(history, conversation_storage.delete_op(message['id']))
+            st.session_state.pop(saved_key, None)
+            st.rerun()
 
 def main():
     st.set_page_config(page_title="Conversation History", layout="wide")
     st.title("Conversation History")
+    metrics.begin_run()
 
-    history = load_history()
+    history = load_cached_history(storage.version(CONVERSATION_ID))
 
     # Display and manage messages
-    updated_history = history.copy()
-    for i, message in enumerate(history):
-        col1, col2, col3 = st.columns([3, 1, 1])
-        
-        with col1:
-            new_content = st.text_area(f"Message {message['id']} - {message['sender']}", 
-                                       value=message['content'], 
-                                       key=f"message_{message['id']}", 
-                                       height=100)
-            if new_content != message['content']:
-                updated_history[i]['content'] = new_content
-        
-        with col2:
-            if st.button("✏️ Save", key=f"save_{message['id']}"):
-                updated_history[i]['content'] = new_content
-                st.success("Changes saved!")
-        
-        with col3:
-            if st.button("🗑️ Delete", key=f"delete_{message['id']}"):
-                updated_history = [m for m in updated_history if m['id'] != message['id']]
-                st.success("Message deleted!")
-
-    # Check if history has been modified
-    if updated_history != history:
-        save_history(updated_history)
-        st.experimental_rerun()
+    for message in visible_rows(history):
+        message_row(history, message)
 
     st.markdown("---")
 
@@ -64,26 +94,29 @@ def main():
     new_sender = st.selectbox("Sender", ["User", "Coder"])
     new_content = st.text_area("Content")
     if st.button("➕ Add Message"):
-        new_id = max([m['id'] for m in updated_history], default=0) + 1
-        updated_history.append({
+        new_id = max([m['id'] for m in history], default=0) + 1
+        new_message = {
             "id": new_id,
             "sender": new_sender,
             "content": new_content
-        })
-        save_history(updated_history)
+        }
+        save_changes(history, conversation_storage.add_op(new_message))
         st.success("New message added!")
-        st.experimental_rerun()
-
-    # Export to CSV
-    if st.button("📁 Export to CSV"):
-        df = pd.DataFrame(updated_history)
-        csv = df.to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="⬇️ Download CSV",
-            data=csv,
-            file_name="conversation_history.csv",
-            mime="text/csv",
-        )
+        st.rerun()
+
+    # Export
+    export_format = st.selectbox("Export format", history_export.available_formats())
+    if st.button("📁 Export"):
+        data, file_name, mime = history_export.export_history(history_export.batched(history), export_format)
+        with data:
+            st.download_button(
+                label=f"⬇️ Download {export_format}",
+                data=data,
+                file_name=file_name,
+                mime=mime,
+            )
+
+    streamlit_ui.show_metrics()
 
 if __name__ == "__main__":
     main()
@@ -1,5 +1,48 @@
 import streamlit as st
-import pandas as pd
+import history_export
+
+VISIBLE_ROWS = 20  # Message rows that get widgets at a time
+
+def visible_rows(history):
+    # Only the rows in view are built as widgets; the scroll position picks
+    # which slice of the history that is.
+    last_row = max(1, len(history))
+    if st.session_state.get("first_row", 1) > last_row:
+        st.session_state.first_row = last_row  # The history shrank since the last run
+    first_row = st.number_input("Scroll to message", min_value=1, max_value=last_row,
+                                step=VISIBLE_ROWS, key="first_row")
+    return history[first_row - 1:first_row - 1 + VISIBLE_ROWS]
+
+@st.fragment
+def message_row(message):
+    # Each row is its own fragment, so Edit and Save only rerun this row.
+    # Delete shifts the rows below it and reruns the app once.
+    col1, col2, col3, col4 = st.columns([3, 1, 1, 1])
+    
+    with col1:
+        st.text_area(f"Message {message['id']} - {message['sender']}", 
+                     value=message['content'], 
+                     key=f"message_{message['id']}", 
+                     height=100)
+    
+    with col2:
+        if st.button("✏️ Edit", key=f"edit_{message['id']}"):
+            st.session_state.editing = message['id']
+            st.session_state.edit_content = message['content']
+    
+    with col3:
+        if st.button("💾 Save", key=f"save_{message['id']}"):
+            if st.session_state.get('editing') == message['id']:
+                message['content'] = st.session_state[f"message_{message['id']}"]
+                st.session_state.editing = None
+                st.success("Message updated!")
+    
+    with col4:
+        if st.button("🗑️ Delete", key=f"delete_{message['id']}"):
+            st.session_state.messages = [m for m in st.session_state.messages if m['id'] != message['id']]
+            st.rerun()
+    
+    st.markdown("---")
 
 def main():
     st.set_page_config(page_title="Conversation History", layout="wide")
@@ -16,34 +59,8 @@ def main():
         ]
 
     # Display and manage messages
-    for i, message in enumerate(st.session_state.messages):
-        col1, col2, col3, col4 = st.columns([3, 1, 1, 1])
-        
-        with col1:
-            st.text_area(f"Message {message['id']} - {message['sender']}", 
-                         value=message['content'], 
-                         key=f"message_{message['id']}", 
-                         height=100)
-        
-        with col2:
-            if st.button("✏️ Edit", key=f"edit_{message['id']}"):
-                st.session_state.editing = message['id']
-                st.session_state.edit_content = message['content']
-        
-        with col3:
-            if st.button("💾 Save", key=f"save_{message['id']}"):
-                if st.session_state.get('editing') == message['id']:
-                    st.session_state.messages[i]['content'] = st.session_state[f"message_{message['id']}"]
-                    st.session_state.editing = None
-                    st.success("Message updated!")
-                    st.experimental_rerun()
-        
-        with col4:
-            if st.button("🗑️ Delete", key=f"delete_{message['id']}"):
-                st.session_state.messages.pop(i)
-                st.experimental_rerun()
-        
-        st.markdown("---")
+    for message in visible_rows(st.session_state.messages):
+        message_row(message)
 
     # Add new message
     st.subheader("Add New Message")
@@ -57,18 +74,19 @@ def main():
             "content": new_content
         })
         st.success("New message added!")
-        st.experimental_rerun()
+        st.rerun()
 
-    # Export to CSV
-    if st.button("📁 Export to CSV"):
-        df = pd.DataFrame(st.session_state.messages)
-        csv = df.to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="⬇️ Download CSV",
-            data=csv,
-            file_name="conversation_history.csv",
-            mime="text/csv",
-        )
+    # Export
+    export_format = st.selectbox("Export format", history_export.available_formats())
+    if st.button("📁 Export"):
+        data, file_name, mime = history_export.export_history(history_export.batched(st.session_state.messages), export_format)
+        with data:
+            st.download_button(
+                label=f"⬇️ Download {export_format}",
+                data=data,
+                file_name=file_name,
+                mime=mime,
+            )
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,101 @@
+import streamlit as st
+
+import conversation_storage
+import metrics
+
+# Pieces shared by the Streamlit conversation apps.
+#
+# Edits typed into a message's text area are buffered in the session until
+# they are saved, one batch per save, with each message's base version so an
+# edit of a message another session changed first is refused rather than
+# overwriting it. On a conflict the buffered edits are dropped and the app
+# reruns with the latest history and an error; apps that keep the history in
+# st.session_state["history"] have it reloaded on that rerun.
+
+
+def save_changes(storage, conversation_id, ops, history=None):
+    # Returns the ops as written, carrying the new message versions, or None
+    # if another session changed one of the messages first. `history` is the
+    # conversation the ops apply to; it seeds it if nothing is stored yet.
+    try:
+        return storage.commit_ops(conversation_id, ops, history)
+    except conversation_storage.ConflictError:
+        return None
+
+
+def forget_message_widgets():
+    # Text areas keep what they last showed; dropping their state makes them
+    # start again from the reloaded message (or its buffered edit), so stale
+    # text isn't buffered as an edit of the new version.
+    for key in [key for key in st.session_state if str(key).startswith("message_")]:
+        del st.session_state[key]
+
+
+def reload_after_conflict():
+    st.session_state.pop('history', None)
+    st.session_state.conflict = True
+    forget_message_widgets()
+    st.rerun()
+
+
+def show_conflict():
+    if st.session_state.pop('conflict', False):
+        st.error("Another session changed this message first. The latest history has been loaded.")
+
+
+def unsaved_edits():
+    # message id -> {"message": ..., "content": edited text}, kept across reruns
+    # and pages until it is saved
+    return st.session_state.setdefault('unsaved', {})
+
+
+def edited_content(message):
+    edit = unsaved_edits().get(message['id'])
+    return edit['content'] if edit else message['content']
+
+
+def track_edit(message, content):
+    edits = unsaved_edits()
+    if content != message['content']:
+        edits[message['id']] = {"message": message, "content": content}
+    else:
+        edits.pop(message['id'], None)
+
+
+def save_edits(storage, conversation_id, history=None, message_ids=None):
+    # Writes the buffered edits (all of them, or those of `message_ids`) as
+    # one batch; returns how many were saved
+    edits = unsaved_edits()
+    ops = [
+        conversation_storage.edit_op(message_id, base_version=conversation_storage.message_version(edits[message_id]['message']),
+                                     content=edits[message_id]['content'])
+        for message_id in (list(edits) if message_ids is None else message_ids)
+        if message_id in edits
+    ]
+    if not ops:
+        return 0
+    saved = save_changes(storage, conversation_id, ops, history)
+    if saved is None:
+        edits.clear()
+        reload_after_conflict()
+    for op in saved:
+        message = edits.pop(op['id'])['message']
+        message['content'] = op['fields']['content']
+        message['version'] = op['version']
+    return len(saved)
+
+
+def show_metrics():
+    # Optional sidebar breakdown of the storage work done by this rerun
+    if not st.sidebar.checkbox("Show metrics"):
+        return
+    st.sidebar.subheader("This rerun")
+    st.sidebar.table([
+        {"operation": t["operation"], "ms": round(t["seconds"] * 1000, 2), "read": t["read"], "written": t["written"]}
+        for t in metrics.run_timings()
+    ])
+    st.sidebar.subheader("Since start")
+    st.sidebar.table([
+        {"operation": operation, "count": m["count"], "ms": round(m["seconds"] * 1000, 2), "read": m["read"], "written": m["written"]}
+        for operation, m in metrics.summary().items()
+    ])
@@ -0,0 +1,80 @@
+import pytest
+
+import history_store
+
+
+def _add(message_id, content):
+    return history_store.add_op({"id": message_id, "sender": "User", "content": content})
+
+
+def test_stale_tracker_sees_edits_across_compactions(tmp_path):
+    # Another process edits a message and compacts twice while this process
+    # keeps its version tracker; the snapshot may come back with the inode it
+    # had, and an edit based on the old version must still conflict.
+    path = str(tmp_path / "history.json")
+    history_store.commit_ops(path, [_add(1, "first")], history=[])
+    history_store.commit_ops(path, [history_store.edit_op(1, base_version=1, content="second")])
+    tracker = history_store._trackers.pop(path)
+
+    history_store.commit_ops(path, [history_store.edit_op(1, base_version=2, content="third")])
+    history_store.compact(path, force=True)
+    history_store.compact(path, force=True)
+    history_store._trackers[path] = tracker
+
+    with pytest.raises(history_store.ConflictError):
+        history_store.commit_ops(path, [history_store.edit_op(1, base_version=2, content="lost")])
+    assert history_store.load_history(path)[0]["content"] == "third"
+
+
+def test_tracker_notices_a_snapshot_with_the_same_inode(tmp_path, monkeypatch):
+    path = str(tmp_path / "history.json")
+    history_store.commit_ops(path, [_add(1, "first")], history=[])
+    tracker = history_store._trackers[path]
+    tracker.refresh()
+    before = tracker._snapshot
+
+    history_store._trackers.pop(path)
+    history_store.commit_ops(path, [history_store.edit_op(1, base_version=1, content="second")])
+    history_store.compact(path, force=True)
+    history_store._trackers[path] = tracker
+
+    # Even if the new snapshot reused the old inode number, the generation
+    # recorded in its index differs
+    assert tracker._identity()[0] != before[0]
+    tracker.refresh()
+    assert tracker.versions[1] == 2
+
+
+def test_generation_survives_compaction(tmp_path):
+    path = str(tmp_path / "history.json")
+    history_store.commit_ops(path, [_add(1, "first")], history=[])
+    history_store.commit_ops(path, [_add(2, "second")])
+    generation = history_store._generation(path)
+    history_store.compact(path, force=True)
+    assert history_store._generation(path) == generation
+    history_store.commit_ops(path, [_add(3, "third")])
+    assert history_store._generation(path) > generation
+
+
+def test_version_is_kept_by_compaction(tmp_path):
+    path = str(tmp_path / "history.json")
+    assert history_store.version(path) is None
+    history_store.commit_ops(path, [_add(1, "first")], history=[])
+    history_store.commit_ops(path, [_add(2, "second")])
+    version = history_store.version(path)
+    history_store.compact(path, force=True)
+    assert history_store.version(path) == version
+    history_store.save_history(path, history_store.load_history(path))
+    assert history_store.version(path) != version
+
+
+def test_versioned_commit_brackets_its_own_records(tmp_path):
+    path = str(tmp_path / "history.json")
+    history_store.commit_ops(path, [_add(1, "first")], history=[])
+    version = history_store.version(path)
+    _, before, after = history_store.commit_ops_versioned(path, [_add(2, "second")])
+    assert (before, after) == (version, history_store.version(path))
+
+    history_store.commit_ops(path, [_add(3, "third")])
+    _, before, _ = history_store.commit_ops_versioned(path, [_add(4, "fourth")])
+    assert before != after